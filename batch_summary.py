@@ -0,0 +1,162 @@
+"""期間中CV・配信費集計のバッチ実行（画面を使わず、複数クライアント分をまとめて Excel 出力する）。
+
+使い方:
+  python batch_summary.py DIR --out OUT [--period 2025-09-01:2025-09-30 ...]
+      DIR 内の <名前>_cv.xlsx と <名前>_cost.xlsx を名前ごとに組にする（片方だけでも可）。
+  python batch_summary.py --manifest jobs.csv --out OUT
+      jobs.csv の列は name,cv,cost,start,end。cv/cost は manifest からの相対パスでよく、片方は空欄可。
+      同じ組を期間違いで複数行書いてもよい（ブックの解析は組ごとに1回）。
+
+--period / start,end を省略した組は、画面の初期値と同じく CV データの全期間で集計する。
+出力は画面のダウンロードと同じ xlsx（OUT/<名前>_集計結果_YYYYMMDD_YYYYMMDD.xlsx）。
+--format parquet / csv を付けると、同じ3表を Parquet / gzip CSV にした zip（.parquet.zip / .csv.zip）も書き出す。
+--history DB を付けると、各組の日別集計を <名前> のデータセットとして履歴ストアにも取り込む。
+組ごとにプロセスプールで並列に処理し、失敗した組があれば終了コード 1 を返す（cron 向け）。
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+from history_store import HistoryStore
+from summary_engine import (
+    load_af_master_index, prepare_inputs, summarize_period, cv_date_range, has_export_rows,
+    EXPORT_FORMATS,
+)
+
+AF_MASTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AFマスター.xlsx")
+
+# =====================
+# ジョブ一覧の組み立て
+# =====================
+def _parse_period(text: str) -> tuple:
+    start, sep, end = text.partition(":")
+    if not sep: raise argparse.ArgumentTypeError(f"期間は START:END で指定してください: {text}")
+    try:
+        start_date, end_date = date.fromisoformat(start), date.fromisoformat(end)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日付は YYYY-MM-DD で指定してください: {text}")
+    if start_date > end_date: raise argparse.ArgumentTypeError(f"開始日が終了日より後です: {text}")
+    return start_date, end_date
+
+def _jobs_from_dir(directory: str, periods: list) -> OrderedDict:
+    jobs = OrderedDict()
+    for kind in ("cv", "cost"):
+        for path in sorted(glob.glob(os.path.join(directory, f"*_{kind}.xlsx"))):
+            name = os.path.basename(path)[:-len(f"_{kind}.xlsx")]
+            jobs.setdefault(name, {"cv": None, "cost": None, "periods": list(periods) or [None]})[kind] = path
+    return jobs
+
+def _jobs_from_manifest(manifest: str, periods: list) -> OrderedDict:
+    base = os.path.dirname(os.path.abspath(manifest))
+    jobs = OrderedDict()
+    with open(manifest, newline="", encoding="utf-8-sig") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            name = (row.get("name") or "").strip()
+            if not name: raise ValueError(f"{manifest}:{line}: name が空です")
+            paths = {k: os.path.join(base, row[k].strip()) if (row.get(k) or "").strip() else None for k in ("cv", "cost")}
+            job = jobs.setdefault((name, paths["cv"], paths["cost"]), {**paths, "periods": []})
+            start, end = (row.get("start") or "").strip(), (row.get("end") or "").strip()
+            if start or end:
+                job["periods"].append(_parse_period(f"{start}:{end}"))
+            else:
+                job["periods"].extend(periods or [None])
+    # 同じ名前で別ブックの組がある場合は出力が衝突しないよう行順の番号を付ける
+    names = [k[0] for k in jobs]
+    return OrderedDict(
+        (k[0] if names.count(k[0]) == 1 else f"{k[0]}_{i}", v) for i, (k, v) in enumerate(jobs.items(), start=1)
+    )
+
+# =====================
+# ワーカー（組ごとに1回だけ解析し、期間ごとに書き出す）
+# =====================
+_worker_af_master = None
+
+def _init_worker(af_master_path: str):
+    global _worker_af_master
+    _worker_af_master, _ = load_af_master_index(af_master_path)
+
+def _run_job(name: str, cv_path: str, cost_path: str, periods: list, out_dir: str, history_path: str = None,
+             formats: tuple = ("xlsx",)) -> list:
+    cv_file = open(cv_path, "rb") if cv_path else None
+    cost_file = open(cost_path, "rb") if cost_path else None
+    try:
+        inputs = prepare_inputs(cv_file, cost_file, _worker_af_master)
+    finally:
+        for f in (cv_file, cost_file):
+            if f is not None: f.close()
+    if history_path:
+        HistoryStore(history_path).ingest_results(name, inputs)
+    written = []
+    for period in dict.fromkeys(periods):
+        if period is None:
+            # 期間の指定なし＝CVデータの全期間
+            period = cv_date_range(inputs["cv"]) if "cv" in inputs else None
+            if period is None: raise ValueError("期間が指定されておらず、CVデータから日付範囲も取得できません")
+        start_date, end_date = period
+        summary = summarize_period(inputs, start_date, end_date)
+        if not has_export_rows(summary): continue
+        for fmt in formats:
+            write, suffix = EXPORT_FORMATS[fmt]
+            path = os.path.join(out_dir, f"{name}_集計結果_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}{suffix}")
+            write(path, **summary)
+            written.append(path)
+    return written
+
+# =====================
+# エントリポイント
+# =====================
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="CVデータ・コストレポートの組をまとめて集計し、xlsx を書き出す。")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("directory", nargs="?", help="<名前>_cv.xlsx / <名前>_cost.xlsx を置いたディレクトリ")
+    src.add_argument("--manifest", help="name,cv,cost,start,end 列の CSV")
+    parser.add_argument("--out", required=True, help="出力先ディレクトリ")
+    parser.add_argument("--period", action="append", type=_parse_period, default=[],
+                        help="集計期間 START:END（YYYY-MM-DD、複数指定可）。省略時は CV データの全期間")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列プロセス数（既定: CPU数）")
+    parser.add_argument("--af-master", default=AF_MASTER_PATH, help="AFマスター.xlsx のパス")
+    parser.add_argument("--history", help="日別集計を取り込む履歴ストア（SQLite）のパス")
+    parser.add_argument("--format", action="append", choices=list(EXPORT_FORMATS), dest="formats",
+                        help="xlsx に加えて書き出す形式（複数指定可。xlsx は常に書き出す）。parquet / csv は3表を1表1ファイルで zip にまとめる")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = _jobs_from_manifest(args.manifest, args.period) if args.manifest else _jobs_from_dir(args.directory, args.period)
+    except (OSError, ValueError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+    if not jobs:
+        print("対象のブックがありません", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    # 索引をここで1回作っておき、各ワーカーは保存済みの索引を読むだけにする
+    load_af_master_index(args.af_master)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=_init_worker,
+                             initargs=(args.af_master,)) as pool:
+        futures = {
+            pool.submit(_run_job, name, job["cv"], job["cost"], job["periods"], args.out, args.history,
+                        tuple(dict.fromkeys(["xlsx", *(args.formats or [])]))): name
+            for name, job in jobs.items()
+        }
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                written = fut.result()
+            except Exception as e:
+                failed += 1
+                print(f"NG {name}: {e}", file=sys.stderr)
+                continue
+            for path in written:
+                print(f"OK {name}: {path}")
+            if not written:
+                print(f"-- {name}: 出力対象の行がありません")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""アプリのコールドスタート（新しいプロセスでの最初の実行）でアップロード画面が出るまでの時間を測る。
+
+  python benchmarks/bench_cold_start.py --runs 5
+  python benchmarks/bench_cold_start.py --budget 1.5 --fail-on-regression
+
+1回ごとに新しい Python プロセスで streamlit.testing の AppTest からアプリを1回実行し、
+再実行ログの first_paint_seconds（スクリプト開始～アップロード欄の表示）と、
+アプリの実行中に新たに読み込まれた重いモジュール（openpyxl / xlsxwriter / plotly）を記録する。
+結果は bench_stages.py と同じ benchmarks/results.jsonl に kind="cold_start" で追記する。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS_PATH = os.path.join(HERE, "results.jsonl")
+APP_PATH = os.path.join(ROOT, "streamlit_app.py")
+
+# アップロード前の画面では読み込まれていてはいけないモジュール
+LAZY_MODULES = ("openpyxl", "xlsxwriter", "plotly.graph_objects")
+
+# 子プロセスで実行するスクリプト（アプリを1回実行し、その間に読み込まれた重いモジュールを JSON で出力する。
+# streamlit 自体が先に読み込むもの（plotly のテーマ登録など）はアプリの責任ではないので数えない）
+_CHILD = """
+import json, sys
+from streamlit.testing.v1 import AppTest
+before = set(sys.modules)
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.run()
+print(json.dumps({"exceptions": [e.value for e in at.exception],
+                  "loaded": [m for m in sys.argv[2:] if m in sys.modules and m not in before]}))
+"""
+
+def _run_once(log_path: str) -> dict:
+    env = {**os.environ, "CV_COST_TRACE_LOG": log_path}
+    proc = subprocess.run([sys.executable, "-c", _CHILD, APP_PATH, *LAZY_MODULES], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+    out = json.loads(proc.stdout.strip().splitlines()[-1])
+    with open(log_path, encoding="utf-8") as f:
+        reruns = [json.loads(line) for line in f if '"event": "rerun"' in line]
+    out["first_paint_seconds"] = reruns[-1]["first_paint_seconds"]
+    out["rerun_seconds"] = reruns[-1]["rerun_seconds"]
+    return out
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="アップロード画面が出るまでの時間（コールドスタート）")
+    parser.add_argument("--runs", type=int, default=5, help="新しいプロセスで実行する回数")
+    parser.add_argument("--budget", type=float, default=2.0, help="first paint の中央値の上限（秒）")
+    parser.add_argument("--label", default="", help="記録に付けるメモ")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="上限超え・重いモジュールの読み込みがあれば終了コード 1")
+    parser.add_argument("--no-record", action="store_true", help="results.jsonl に追記しない")
+    args = parser.parse_args(argv)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in range(max(args.runs, 1)):
+            run = _run_once(os.path.join(tmp, f"trace_{n}.log"))
+            runs.append(run)
+            print(f"  run {n + 1}: first paint {run['first_paint_seconds']:.3f}s"
+                  f"（再実行全体 {run['rerun_seconds']:.3f}s）" + (f" 読み込み済み: {run['loaded']}" if run["loaded"] else ""))
+
+    first_paint = [r["first_paint_seconds"] for r in runs]
+    median = statistics.median(first_paint)
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+    errors = [e for r in runs for e in r["exceptions"]]
+    print(f"\nfirst paint: 中央値 {median:.3f}s / 最小 {min(first_paint):.3f}s / 最大 {max(first_paint):.3f}s（上限 {args.budget:.2f}s）")
+    problems = []
+    if median > args.budget: problems.append(f"中央値が上限 {args.budget:.2f}s を超えました")
+    if loaded: problems.append(f"アップロード前に読み込まれたモジュール: {', '.join(loaded)}")
+    if errors: problems.append(f"アプリで例外: {errors[0]}")
+    for p in problems: print(f"  ← {p}")
+
+    if not args.no_record:
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "kind": "cold_start",
+            "label": args.label,
+            "first_paint_seconds": {"median": round(median, 4), "min": round(min(first_paint), 4),
+                                    "max": round(max(first_paint), 4)},
+            "loaded_before_upload": loaded,
+        }
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 1 if (problems and args.fail_on_regression) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""処理段ごとの所要時間・ピークメモリを測り、結果を JSONL に記録して前回と比べる。
+
+  python benchmarks/bench_stages.py --days 365 --codes 400 --listing-sheets 2
+  python benchmarks/bench_stages.py --days 1095 --codes 1500 --label after-change --fail-on-regression
+
+段: AFマスタ読み込み → CV解析 → コード分類 → CV集計 → コスト解析 → 費用集計
+    → 日別コスト → 目標 → Excel出力。
+入力は generate_workbooks.py で規模ごとに作って benchmarks/.data/ に置き、次回以降は使い回す。
+結果は benchmarks/results.jsonl に1実行1行で追記し、同じ規模の直前の記録と比較して表示する。
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from generate_workbooks import generate  # noqa: E402
+from summary_engine import (  # noqa: E402
+    read_af_master, compile_af_master, parse_cv, classify_codes, build_cv_cube, daily_cv_by_media,
+    filter_period, cv_totals_for_period, load_cost_sheets, build_cost_cube, cost_summary_for_period,
+    build_daily_cost_report_all_range, build_daily_targets_from_cost, summarize_period, write_export_workbook,
+)
+
+RESULTS_PATH = os.path.join(HERE, "results.jsonl")
+DATA_DIR = os.path.join(HERE, ".data")
+
+# =====================
+# 段の定義（ctx を受け取り、後段で使う値を dict で返す）
+# =====================
+def _stage_master(ctx):
+    return {"af_master": compile_af_master(read_af_master(ctx["paths"]["master"]))}
+
+def _stage_cv_parse(ctx):
+    return {"cv": parse_cv(BytesIO(ctx["cv_bytes"]), ctx["af_master"])}
+
+def _stage_classify(ctx):
+    return {"cv_codes": classify_codes(ctx["cv"].columns[1:], ctx["af_master"])}
+
+def _stage_cv_aggregate(ctx):
+    cube = build_cv_cube(ctx["cv"], ctx["cv_codes"])
+    cv_totals_for_period(cube, ctx["start"], ctx["end"])
+    daily_cv_by_media(filter_period(ctx["cv"], ctx["start"], ctx["end"]), ctx["cv_codes"])
+    return {"cv_cube": cube}
+
+def _stage_cost_parse(ctx):
+    return {"cost_sheets": load_cost_sheets(BytesIO(ctx["cost_bytes"]), executor=ctx["executor"])}
+
+def _stage_cost_summary(ctx):
+    cube = build_cost_cube(ctx["cost_sheets"])
+    cost_summary_for_period(cube, ctx["start"], ctx["end"])
+    return {"cost_cube": cube}
+
+def _stage_daily_cost(ctx):
+    return {"daily_cost": build_daily_cost_report_all_range(ctx["cost_sheets"])}
+
+def _stage_targets(ctx):
+    return {"daily_targets": build_daily_targets_from_cost(ctx["cost_sheets"])}
+
+def _stage_export(ctx):
+    summary = summarize_period(ctx, ctx["start"], ctx["end"])
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        write_export_workbook(path, **summary)
+    finally:
+        os.remove(path)
+    return {}
+
+STAGES = [
+    ("master_load", _stage_master),
+    ("cv_parse", _stage_cv_parse),
+    ("classification", _stage_classify),
+    ("cv_aggregation", _stage_cv_aggregate),
+    ("cost_parse", _stage_cost_parse),
+    ("cost_summary", _stage_cost_summary),
+    ("daily_cost", _stage_daily_cost),
+    ("targets", _stage_targets),
+    ("export", _stage_export),
+]
+
+# =====================
+# 計測
+# =====================
+def _measure(ctx: dict, repeat: int, memory: bool) -> dict:
+    stages = {}
+    for name, fn in STAGES:
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            out = fn(ctx)
+            times.append(time.perf_counter() - t0)
+        ctx.update(out)
+        stage = {"seconds": round(min(times), 4)}
+        if memory:
+            # tracemalloc は遅くなるので時間とは別に1回だけ流す
+            tracemalloc.start()
+            fn(ctx)
+            stage["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            tracemalloc.stop()
+        stages[name] = stage
+        print(f"  {name:<16}{stage['seconds']:>9.3f}s" + (f"{stage['peak_mb']:>10.1f}MB" if memory else ""))
+    return stages
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def _previous(scale: dict) -> dict:
+    if not os.path.exists(RESULTS_PATH): return None
+    last = None
+    with open(RESULTS_PATH, encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get("scale") == scale: last = rec
+    return last
+
+def _compare(prev: dict, cur: dict, threshold: float) -> list:
+    """前回より threshold 以上（かつ 50ms 以上）遅くなった段の名前を返す。"""
+    print(f"\n前回 {prev['timestamp']} ({prev.get('git_rev') or '-'} {prev.get('label') or ''}) との比較")
+    regressed = []
+    for name, stage in cur["stages"].items():
+        before = prev["stages"].get(name)
+        if before is None: continue
+        delta = stage["seconds"] - before["seconds"]
+        ratio = delta / before["seconds"] if before["seconds"] else 0.0
+        mark = ""
+        if ratio > threshold and delta > 0.05:
+            mark = "  ← 遅くなりました"
+            regressed.append(name)
+        print(f"  {name:<16}{before['seconds']:>9.3f}s → {stage['seconds']:>8.3f}s ({ratio:+7.1%}){mark}")
+    return regressed
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="処理段ごとのベンチマーク")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--codes", type=int, default=400)
+    parser.add_argument("--listing-sheets", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3, help="各段の繰り返し回数（最小値を記録）")
+    parser.add_argument("--cost-workers", type=int, default=0, help="コスト解析のプロセス数（0 は逐次）")
+    parser.add_argument("--no-memory", action="store_true", help="ピークメモリを測らない")
+    parser.add_argument("--label", default="", help="記録に付けるメモ")
+    parser.add_argument("--threshold", type=float, default=0.10, help="遅くなったとみなす比率")
+    parser.add_argument("--fail-on-regression", action="store_true", help="遅くなった段があれば終了コード 1")
+    parser.add_argument("--no-record", action="store_true", help="results.jsonl に追記しない")
+    args = parser.parse_args(argv)
+
+    scale = {"days": args.days, "codes": args.codes, "listing_sheets": args.listing_sheets}
+    data_dir = os.path.join(DATA_DIR, f"{args.days}d_{args.codes}c_{args.listing_sheets}s")
+    paths = {k: os.path.join(data_dir, f) for k, f in
+             (("master", "AFマスター.xlsx"), ("cv", "cv.xlsx"), ("cost", "cost.xlsx"))}
+    if not all(os.path.exists(p) for p in paths.values()):
+        print(f"入力を生成中: {data_dir}")
+        paths = generate(data_dir, args.days, args.codes, args.listing_sheets)
+
+    with open(paths["cv"], "rb") as f: cv_bytes = f.read()
+    with open(paths["cost"], "rb") as f: cost_bytes = f.read()
+    start = datetime(2024, 1, 1).date()
+    ctx = {"paths": paths, "cv_bytes": cv_bytes, "cost_bytes": cost_bytes,
+           "start": start, "end": start + timedelta(days=max(args.days - 1, 0))}
+
+    print(f"規模: {args.days}日 × {args.codes}コード × Listing {args.listing_sheets}シート")
+    executor = ProcessPoolExecutor(args.cost_workers) if args.cost_workers > 0 else None
+    try:
+        ctx["executor"] = executor
+        stages = _measure(ctx, max(args.repeat, 1), not args.no_memory)
+    finally:
+        if executor is not None: executor.shutdown()
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_rev": _git_rev(),
+        "label": args.label,
+        "scale": scale,
+        "cost_workers": args.cost_workers,
+        "env": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                "machine": platform.machine(), "cpus": os.cpu_count()},
+        "stages": stages,
+    }
+    prev = _previous(scale)
+    regressed = _compare(prev, record, args.threshold) if prev else []
+    if not args.no_record:
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 1 if (regressed and args.fail_on_regression) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""ベンチマーク用の合成ブック（CVデータ・コストレポート・AFマスター）を作る。
+
+実データと同じレイアウトで、規模を 日数 × コード数 × Listingシート数 で変えられる。
+  CVデータ      : 1行目が見出し、A列が日付（yyyymmdd の数値）、B列以降が AFコード列
+  コストレポート: Listing*（B列が日付、列定義の列に値）、Affiliate（A列が日付）、
+                  Display / Display_nonIFRS（B列が yyyy/mm/dd の文字列）、集計対象外のシート
+  AFマスター    : 2行目が見出し、B:D が AFコード/割り振り/領域
+
+  python benchmarks/generate_workbooks.py OUT --days 365 --codes 400 --listing-sheets 2
+"""
+import argparse
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import xlsxwriter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from summary_engine import COST_SHEET_SPEC, LISTING_COST_COLS  # noqa: E402
+
+LISTING_MEDIA = [k for k in LISTING_COST_COLS if k != "Listing_total"] + [
+    "LS_Google単体→2025年11月よりMSその他", "LS_Yahoo単体（PSD）",
+]
+DISPLAY_MEDIA = ["DS_Meta", "DS_Yahoo", "DS_Google", "DS_Criteo", "DS_Microsoft", "DS_X"]
+AFFILIATE_PREFIXES = ["GEN", "AFA", "AFP", "RAA"]
+
+def _sheet_width(sheet_type: str) -> int:
+    spec = COST_SHEET_SPEC[sheet_type]
+    return max(spec["date"] + spec["values"]) + 4
+
+def _write_master(path: str, listing_codes: list, display_codes: list, rng):
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    ws = wb.add_worksheet("割り振りマスター")
+    ws.write_row(1, 1, ["AFコード", "割り振り", "領域", "備考"])
+    r = 2
+    for code in listing_codes:
+        ws.write_row(r, 1, [code, LISTING_MEDIA[rng.integers(len(LISTING_MEDIA))], "Listing", "-"]); r += 1
+    for code in display_codes:
+        ws.write_row(r, 1, [code, DISPLAY_MEDIA[rng.integers(len(DISPLAY_MEDIA))], "Display", "-"]); r += 1
+    wb.close()
+
+def _write_cv(path: str, dates: list, codes: list, rng):
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    ws = wb.add_worksheet("CV")
+    ws.write_row(0, 0, ["日付"] + codes)
+    values = rng.poisson(1.0, (len(dates), len(codes))).astype(float)
+    values[rng.random(values.shape) < 0.05] = np.nan  # 空欄
+    for r, d in enumerate(dates, start=1):
+        ws.write_number(r, 0, int(d.strftime("%Y%m%d")))
+        for c, v in enumerate(values[r - 1], start=1):
+            if v == v: ws.write_number(r, c, v)
+    wb.close()
+
+def _write_cost_sheet(wb, name: str, sheet_type: str, dates: list, rng, date_format):
+    ws = wb.add_worksheet(name)
+    width = _sheet_width(sheet_type)
+    date_col = COST_SHEET_SPEC[sheet_type]["date"][0]
+    ws.write_row(0, 0, [f"項目{i}" for i in range(width)])
+    values = np.round(rng.random((len(dates), width)) * 1000, 2)
+    for r, d in enumerate(dates, start=1):
+        for c in range(width):
+            if c == date_col: continue
+            ws.write_number(r, c, values[r - 1, c])
+        if date_format is None:
+            ws.write_string(r, date_col, d.strftime("%Y/%m/%d"))
+        else:
+            ws.write_datetime(r, date_col, datetime.combine(d, datetime.min.time()), date_format)
+    # 集計行（日付列は文字列）
+    ws.write_string(len(dates) + 1, date_col, "合計")
+
+def _write_cost(path: str, dates: list, listing_sheets: int, rng):
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    fmt = wb.add_format({"num_format": "yyyy/m/d"})
+    for k in range(listing_sheets):
+        _write_cost_sheet(wb, f"Listing_{k + 1}", "Listing", dates, rng, fmt)
+    _write_cost_sheet(wb, "Affiliate", "Affiliate", dates, rng, fmt)
+    _write_cost_sheet(wb, "Display", "Display", dates, rng, None)
+    _write_cost_sheet(wb, "Display_nonIFRS", "Display", dates, rng, None)
+    wb.add_worksheet("サマリー").write_row(0, 0, ["集計対象外"])
+    wb.close()
+
+def generate(out_dir: str, days: int = 365, codes: int = 400, listing_sheets: int = 2,
+             start: date = date(2024, 1, 1), seed: int = 0) -> dict:
+    """out_dir に cv.xlsx / cost.xlsx / AFマスター.xlsx を書き出し、各パスを返す。
+    CVのコード列は Listing 60% / Display 25% / Affiliate 10% / マスタ未登録 5%。"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    dates = [start + timedelta(days=i) for i in range(days)]
+    n_listing, n_display, n_aff = int(codes * 0.6), int(codes * 0.25), int(codes * 0.1)
+    n_unknown = max(codes - n_listing - n_display - n_aff, 0)
+    listing_codes = [f"LTG{i:05d}" for i in range(n_listing)]
+    display_codes = [f"DTG{i:05d}" for i in range(n_display)]
+    aff_codes = [f"{AFFILIATE_PREFIXES[i % len(AFFILIATE_PREFIXES)]}{i:05d}" for i in range(n_aff)]
+    unknown_codes = [f"UNK{i:05d}" for i in range(n_unknown)]
+    cv_codes = listing_codes + display_codes + aff_codes + unknown_codes
+    rng.shuffle(cv_codes)
+
+    paths = {
+        "master": os.path.join(out_dir, "AFマスター.xlsx"),
+        "cv": os.path.join(out_dir, "cv.xlsx"),
+        "cost": os.path.join(out_dir, "cost.xlsx"),
+    }
+    _write_master(paths["master"], listing_codes, display_codes, rng)
+    _write_cv(paths["cv"], dates, cv_codes, rng)
+    _write_cost(paths["cost"], dates, listing_sheets, rng)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベンチマーク用の合成ブックを作る")
+    parser.add_argument("out", help="出力先ディレクトリ")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--codes", type=int, default=400, help="CVデータのコード列数")
+    parser.add_argument("--listing-sheets", type=int, default=2)
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2024, 1, 1))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for kind, path in generate(args.out, args.days, args.codes, args.listing_sheets, args.start, args.seed).items():
+        print(f"{kind}: {path}")
+
+if __name__ == "__main__":
+    main()
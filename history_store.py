@@ -0,0 +1,201 @@
+"""日別集計の履歴ストア（SQLite、月単位パーティション）。
+
+アップロードのたびに全履歴を持ち直すのではなく、日別集計（CV の 日付×分類×媒体、
+日別シートの媒体別CV、費用区分、Forecast/実績、目標）を系列ごとにローカルの SQLite に蓄積する。
+取り込みは月単位で内容ダイジェストを比較し、変わった月だけ、値が変わった日だけを upsert する。
+"""
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from summary_engine import COST_SUMMARY_KEYS, DAILY_COST_REPORT_COLUMNS, DailyCube, daily_cv_by_media
+
+# 系列名（daily.series）
+CV_SERIES = "cv"            # k1=分類, k2=媒体
+COST_SERIES = "cost"        # k1=費用区分（COST_SUMMARY_KEYS）
+REPORT_SERIES = "report"    # k1=コストレポート日別の列名（Forecast_AFCV_Listing など）
+TARGET_SERIES = "target"    # k1=割り振り
+ALLOC_SERIES = "alloc"      # k1=割り振り, k2=領域（日別シートの正のCV合計。無い日は 0）
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily (
+    dataset TEXT NOT NULL, series TEXT NOT NULL, date TEXT NOT NULL, month TEXT NOT NULL,
+    k1 TEXT NOT NULL, k2 TEXT NOT NULL DEFAULT '', value REAL NOT NULL,
+    PRIMARY KEY (dataset, series, date, k1, k2)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_month ON daily (dataset, series, month);
+CREATE TABLE IF NOT EXISTS partitions (
+    dataset TEXT NOT NULL, series TEXT NOT NULL, month TEXT NOT NULL, digest TEXT NOT NULL,
+    PRIMARY KEY (dataset, series, month)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS generations (
+    dataset TEXT PRIMARY KEY, generation INTEGER NOT NULL
+);
+"""
+
+_UPSERT = """
+INSERT INTO daily (dataset, series, date, month, k1, k2, value) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (dataset, series, date, k1, k2) DO UPDATE SET value = excluded.value
+WHERE daily.value IS NOT excluded.value
+"""
+
+def _long_from_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """日付×列（列は1段または (k1, k2) の2段）の表を (date, k1, k2, value) の縦持ちにする。"""
+    if isinstance(frame.columns, pd.MultiIndex):
+        k1 = frame.columns.get_level_values(0)
+        k2 = frame.columns.get_level_values(1)
+    else:
+        k1, k2 = frame.columns, pd.Index([""] * len(frame.columns))
+    n_dates, n_cols = frame.shape
+    return pd.DataFrame({
+        "date": np.repeat(frame.index.values, n_cols),
+        "k1": np.tile(np.asarray(k1, dtype=object), n_dates),
+        "k2": np.tile(np.asarray(k2, dtype=object), n_dates),
+        "value": frame.to_numpy(dtype=float).ravel(),
+    })
+
+def _long_from_cube(cube: DailyCube) -> pd.DataFrame:
+    """キューブの日別値を (date, k1, k2, value) の縦持ちにする。"""
+    return _long_from_frame(cube.daily())
+
+def _long_from_allocation(alloc: pd.DataFrame, codes: pd.DataFrame, dates) -> pd.DataFrame:
+    """日別シートの表（daily_cv_by_media）を dates × (割り振り, 領域) の全組み合わせで縦持ちにする。
+    組はアップロードの全コードの媒体から作り、行の無い組も 0 で書く（後のアップロードで消えた行も
+    上書きされる。読み出し時に 0 を落とす）。"""
+    if len(codes) == 0: return None
+    category = codes.groupby("媒体", sort=False)["分類"].first()
+    columns = pd.MultiIndex.from_arrays([category.index, category.to_numpy()], names=["割り振り", "領域"])
+    grid = pd.DataFrame(0.0, index=pd.DatetimeIndex(dates), columns=columns)
+    if alloc is not None and len(alloc) > 0:
+        sums = alloc.pivot_table(index="日付", columns=["割り振り", "領域"], values="合計値", aggfunc="sum",
+                                 fill_value=0.0, observed=True)
+        grid = sums.reindex(index=grid.index, columns=columns, fill_value=0.0)
+    return _long_from_frame(grid)
+
+class HistoryStore:
+    """データセット（クライアント等）ごとの日別系列を蓄積する。スレッド間で共有してよい。"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def generation(self, dataset: str) -> int:
+        """書き込みのたびに増える番号（読み出し結果のキャッシュキーに使う）。"""
+        with self._lock:
+            row = self._conn.execute("SELECT generation FROM generations WHERE dataset = ?", (dataset,)).fetchone()
+        return row[0] if row else 0
+
+    # ---- 取り込み ----
+    def ingest(self, dataset: str, series: str, long: pd.DataFrame) -> int:
+        """縦持ち (date, k1, [k2,] value) を取り込み、書き換えた行数を返す。
+        月ごとのダイジェストが前回と同じ月は読み飛ばす。"""
+        if long is None or len(long) == 0: return 0
+        long = pd.DataFrame({
+            "date": pd.to_datetime(long["date"]).dt.strftime("%Y-%m-%d"),
+            "k1": long["k1"].fillna("").astype(str),
+            "k2": long["k2"].fillna("").astype(str) if "k2" in long else "",
+            "value": pd.to_numeric(long["value"], errors="coerce").fillna(0.0).astype(float),
+        }).sort_values(["date", "k1", "k2"], kind="stable")
+        long["month"] = long["date"].str[:7]
+        with self._lock:
+            stored = dict(self._conn.execute(
+                "SELECT month, digest FROM partitions WHERE dataset = ? AND series = ?", (dataset, series)
+            ).fetchall())
+            changed = 0
+            with self._conn:
+                for month, part in long.groupby("month", sort=True):
+                    digest = hashlib.sha256(
+                        pd.util.hash_pandas_object(part[["date", "k1", "k2", "value"]], index=False).values.tobytes()
+                    ).hexdigest()
+                    if stored.get(month) == digest: continue
+                    before = self._conn.total_changes
+                    self._conn.executemany(_UPSERT, (
+                        (dataset, series, d, month, a, b, v)
+                        for d, a, b, v in zip(part["date"], part["k1"], part["k2"], part["value"])
+                    ))
+                    changed += self._conn.total_changes - before
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO partitions (dataset, series, month, digest) VALUES (?, ?, ?, ?)",
+                        (dataset, series, month, digest),
+                    )
+                if changed:
+                    self._conn.execute(
+                        "INSERT INTO generations (dataset, generation) VALUES (?, 1) "
+                        "ON CONFLICT (dataset) DO UPDATE SET generation = generation + 1", (dataset,)
+                    )
+        return changed
+
+    def ingest_results(self, dataset: str, results: dict) -> int:
+        """パイプラインの結果（cv_cube / cv＋cv_codes の日別CV / cost_cube / daily_cost / daily_targets）のうち、
+        あるものを取り込む。"""
+        changed = 0
+        if results.get("cv_cube") is not None:
+            changed += self.ingest(dataset, CV_SERIES, _long_from_cube(results["cv_cube"]))
+        if results.get("cv") is not None and results.get("cv_codes") is not None and results.get("cv_cube") is not None:
+            alloc = daily_cv_by_media(results["cv"], results["cv_codes"])
+            changed += self.ingest(dataset, ALLOC_SERIES, _long_from_allocation(alloc, results["cv_codes"], results["cv_cube"].dates))
+        if results.get("cost_cube") is not None:
+            changed += self.ingest(dataset, COST_SERIES, _long_from_cube(results["cost_cube"]))
+        report = results.get("daily_cost")
+        if report is not None and not report.empty:
+            long = report.melt(id_vars="日付", var_name="k1", value_name="value").rename(columns={"日付": "date"})
+            changed += self.ingest(dataset, REPORT_SERIES, long)
+        targets = results.get("daily_targets")
+        if targets is not None and not targets.empty:
+            long = targets.rename_axis(["date", "k1"]).rename("value").reset_index()
+            changed += self.ingest(dataset, TARGET_SERIES, long)
+        return changed
+
+    # ---- 読み出し ----
+    def _read(self, dataset: str, series: str) -> pd.DataFrame:
+        with self._lock:
+            df = pd.read_sql_query(
+                "SELECT date, k1, k2, value FROM daily WHERE dataset = ? AND series = ? ORDER BY date, k1, k2",
+                self._conn, params=(dataset, series),
+            )
+        df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+        return df
+
+    def has_series(self, dataset: str, series: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM partitions WHERE dataset = ? AND series = ? LIMIT 1", (dataset, series)
+            ).fetchone() is not None
+
+    def cv_cube(self, dataset: str) -> DailyCube:
+        df = self._read(dataset, CV_SERIES)
+        frame = df.pivot_table(index="date", columns=["k1", "k2"], values="value", aggfunc="sum", fill_value=0.0)
+        frame.columns = frame.columns.set_names(["分類", "媒体"])
+        return DailyCube(frame)
+
+    def cost_cube(self, dataset: str) -> DailyCube:
+        df = self._read(dataset, COST_SERIES)
+        frame = df.pivot_table(index="date", columns="k1", values="value", aggfunc="sum", fill_value=0.0)
+        return DailyCube(frame.reindex(columns=list(COST_SUMMARY_KEYS), fill_value=0.0))
+
+    def daily_cost_report(self, dataset: str) -> pd.DataFrame:
+        """コストレポート日別（全期間）。列順は build_daily_cost_report_all_range と同じ。"""
+        df = self._read(dataset, REPORT_SERIES)
+        frame = df.pivot_table(index="date", columns="k1", values="value", aggfunc="sum", fill_value=0.0)
+        frame = frame.reindex(pd.date_range(frame.index.min(), frame.index.max(), freq="D"), fill_value=0.0)
+        frame = frame.reindex(columns=DAILY_COST_REPORT_COLUMNS, fill_value=0.0).rename_axis("日付").reset_index()
+        frame.columns.name = None
+        return frame
+
+    def daily_targets(self, dataset: str) -> pd.Series:
+        """(日付, 割り振り) 索引の目標（build_daily_targets_from_cost と同じ形）。"""
+        df = self._read(dataset, TARGET_SERIES)
+        return df.set_index(["date", "k1"])["value"].rename_axis(["日付", "割り振り"]).rename("目標").sort_index()
+
+    def daily_allocation(self, dataset: str) -> pd.DataFrame:
+        """日別シートの表（全期間。daily_cv_by_media と同じ列・並び・型）。"""
+        df = self._read(dataset, ALLOC_SERIES)
+        df = df[df["value"] > 0]
+        out = pd.DataFrame({"日付": df["date"], "割り振り": df["k1"], "領域": df["k2"], "合計値": df["value"]})
+        out = out.sort_values(["日付", "割り振り"]).reset_index(drop=True)
+        return out.astype({"割り振り": "category", "領域": "category", "合計値": "float32"})
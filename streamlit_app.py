@@ -1,74 +1,446 @@
+import time
+# 再実行1回分の所要時間の起点（プロセスで最初の実行はモジュールの import も含めて測る）
+_RERUN_T0 = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
-import numpy as np
+import os
+import sys
+import json
+import uuid
+import logging
+import hashlib
+import tempfile
+import multiprocessing
+import threading
 from io import BytesIO
-from datetime import date
-from pandas.api.types import is_datetime64_any_dtype as is_dt
-from collections import defaultdict
+from functools import partial
+from datetime import date, datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from summary_engine import (
+    parse_cv, classify_codes, load_cost_sheets, load_af_master_index,
+    build_cv_cube, daily_cv_by_media, build_cost_cube, build_daily_cost_report_all_range,
+    build_daily_targets_from_cost, filter_period, cv_date_range, period_days, cv_totals_for_period,
+    cost_summary_for_period, build_condition_table, EXPORT_FORMATS, DailyCube,
+    TREND_TIERS, cost_trend_tiers, cv_trend_tiers, target_trend_tiers, pick_trend_tier, trend_slice,
+    split_periods, build_period_comparison, write_comparison_workbook,
+)
+from history_store import HistoryStore, CV_SERIES, COST_SERIES, REPORT_SERIES, TARGET_SERIES, ALLOC_SERIES
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # ページ設定
 st.set_page_config(layout="wide")
 st.title("📊 期間中CV・配信費集計")
 
 # =====================
-# ユーティリティ
+# 計測（処理段ごとの時間・ピークRSS増分・行列数・キャッシュ結果。サイドバーのデバッグ表示と再実行ごとの JSON ログ）
 # =====================
-def _norm_text(x) -> str:
-    if x is None:
-        return ""
-    return str(x).replace("\r", "").replace("\n", "").strip()
+# 未設定なら標準エラー出力、設定すればそのファイルに1行1レコードで追記する
+TRACE_LOG_PATH = os.environ.get("CV_COST_TRACE_LOG")
+
+def _peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+def _shape(value):
+    """(行数, 列数)。DataFrame 以外はキューブの大きさや、中の DataFrame の合計で表す。"""
+    if isinstance(value, pd.DataFrame): return value.shape
+    if isinstance(value, pd.Series): return (len(value), 1)
+    if isinstance(value, DailyCube): return (len(value.dates), len(value.columns))
+    if isinstance(value, dict): value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        shapes = [s for s in (_shape(v) for v in value) if s is not None]
+        if shapes: return (sum(r for r, _ in shapes), max(c for _, c in shapes))
+    return None
 
-MEDIA_ALIAS = {
-    "LS_Yahoo単体（PSD）": "LS_Yahoo単体",
-}
-def _alias_media(media: str) -> str:
-    m = _norm_text(media)
-    return MEDIA_ALIAS.get(m, m)
-
-def _coerce_date_series(s: pd.Series) -> pd.Series:
-    if s is None:
-        return pd.Series(dtype="datetime64[ns]")
-    if is_dt(s):
-        return s
-    s2 = s.copy()
-    num = pd.to_numeric(s2, errors="coerce")
-    num_mask = num.notna()
-    if num_mask.any():
-        s2.loc[num_mask] = (
-            pd.to_timedelta(num[num_mask], unit="D")
-            + pd.Timestamp("1899-12-30")
-        )
-    s2 = pd.to_datetime(s2, errors="coerce")
-    return s2
-
-def _excel_col_to_idx(col: str) -> int:
-    col = _norm_text(col).upper()
-    idx = 0
-    for ch in col:
-        if "A" <= ch <= "Z":
-            idx = idx * 26 + (ord(ch) - ord("A") + 1)
-    return idx - 1
+class _StageMeter:
+    """with ブロック1つ分の時間とピークRSSの増分（プロセス全体の最大値の伸び）を測り、
+    入出力の行列数・キャッシュ結果と合わせて record に残す。"""
+    def __init__(self, name: str, inputs=()):
+        self.record = {"stage": name}
+        shape = _shape(list(inputs))
+        if shape is not None: self.record["rows_in"], self.record["cols_in"] = shape
+
+    def output(self, value):
+        shape = _shape(value)
+        if shape is not None: self.record["rows_out"], self.record["cols_out"] = shape
+        return value
+
+    def __enter__(self):
+        self._rss0 = _peak_rss_mb()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["seconds"] = round(time.perf_counter() - self._t0, 4)
+        if self._rss0 is not None:
+            self.record["peak_rss_delta_mb"] = round(_peak_rss_mb() - self._rss0, 1)
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        return False
+
+def _traced(trace: list, name: str, fn, *inputs):
+    """fn() を計測して trace に追記し、結果を返す。"""
+    meter = _StageMeter(name, inputs)
+    try:
+        with meter:
+            return meter.output(fn())
+    finally:
+        trace.append(meter.record)
+
+@st.cache_resource
+def _get_trace_logger() -> logging.Logger:
+    logger = logging.getLogger("cv_cost.trace")
+    handler = logging.FileHandler(TRACE_LOG_PATH, encoding="utf-8") if TRACE_LOG_PATH else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+def _emit_trace(logger: logging.Logger, event: str, **fields):
+    logger.info(json.dumps({"event": event, "ts": datetime.now().isoformat(timespec="milliseconds"), **fields},
+                           ensure_ascii=False, default=str))
+
+def _report_rerun(job, trace: list, **fields):
+    """再実行1回分の計測を JSON ログに出し、デバッグ表示が有効ならサイドバーに表で出す。
+    パイプラインの計測は完了後の最初の再実行で1回だけログに含める。"""
+    payload = {
+        "session": st.session_state.setdefault("_trace_session", uuid.uuid4().hex[:8]),
+        "inputs": [d[:12] if d else None for d in job.key[:2]] if job is not None else None,
+        "rerun_seconds": round(time.perf_counter() - _RERUN_T0, 4),
+        "first_paint_seconds": first_paint_seconds,
+        "stages": trace, **fields,
+    }
+    if job is not None and job.done and not job.trace_logged:
+        payload["pipeline"] = job.trace
+        job.trace_logged = True
+    _emit_trace(_get_trace_logger(), "rerun", **payload)
+    if not st.session_state.get("_show_trace"): return
+    with st.sidebar:
+        st.subheader("⏱️ 処理時間")
+        st.caption(f"この再実行: {payload['rerun_seconds']:.3f} 秒")
+        if job is not None and job.trace:
+            st.caption("アップロードの解析・事前集計（入力ごとに1回）")
+            st.dataframe(pd.DataFrame(job.trace), hide_index=True)
+        if trace:
+            st.caption("この再実行の処理")
+            st.dataframe(pd.DataFrame(trace), hide_index=True)
 
 # =====================
-# AFマスタ（Affiliate以外用）
+# アップロード解析結果のキャッシュ（内容ハッシュ＋パーサーバージョンがキー／全セッション共有）
 # =====================
-af_df = pd.read_excel(
-    "AFマスター.xlsx", usecols="B:D", header=1, engine="openpyxl"
-)
-af_df.columns = ["AFコード", "媒体", "分類"]
-af_df = af_df[
-    ~af_df["分類"].astype(str).str.contains("display", case=False, na=False)
-].copy()
+# 解析結果の形が変わったら上げる（古いキャッシュを無効化する）
+PARSER_VERSION = "4"
+UPLOAD_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+UPLOAD_CACHE_MAX_ENTRIES = 32
+
+def _frame_nbytes(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, dict):
+        return sum(_frame_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_frame_nbytes(v) for v in value)
+    return int(getattr(value, "nbytes", 0))
+
+class _UploadCache:
+    """解析済みDataFrameのLRUキャッシュ。件数とメモリ上限を超えたら古い順に破棄する。
+    値は複数セッションで共有されるため、呼び出し側で書き換えないこと。"""
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def get_or_build(self, key, builder, stats: dict = None):
+        # stats を渡すと stats["cache"] に "hit" / "miss" を入れる
+        value = self.get(key)
+        if stats is not None: stats["cache"] = "miss" if value is None else "hit"
+        if value is None:
+            value = builder()
+            self.put(key, value, _frame_nbytes(value))
+        return value
+
+    def put(self, key, value, nbytes: int):
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= self._items.pop(key)[1]
+            if nbytes > self.max_bytes: return
+            self._items[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._items and (self._nbytes > self.max_bytes or len(self._items) > self.max_entries):
+                _, (_, old_nbytes) = self._items.popitem(last=False)
+                self._nbytes -= old_nbytes
+
+@st.cache_resource
+def _get_upload_cache() -> _UploadCache:
+    return _UploadCache(UPLOAD_CACHE_MAX_BYTES, UPLOAD_CACHE_MAX_ENTRIES)
+
+def _upload_digest(file) -> str:
+    # 再実行ごとに再計算しないよう、アップロードIDごとにセッション内で保持する
+    memo = st.session_state.setdefault("_upload_digests", {})
+    file_id = getattr(file, "file_id", None)
+    if file_id is None or file_id not in memo:
+        digest = hashlib.sha256(file.getvalue()).hexdigest()
+        if file_id is None: return digest
+        memo[file_id] = digest
+    return memo[file_id]
+
+
+# =====================
+# AFマスタ（Affiliate以外用。コンパイル済み索引を全セッションで共有）
+# =====================
+AF_MASTER_PATH = "AFマスター.xlsx"
+
+@st.cache_resource(max_entries=1)
+def _get_af_master(mtime_ns: int, size: int):
+    # 更新日時・サイズが変わった時だけ読み直す（内容が同じなら保存済みの索引を使う）
+    return load_af_master_index(AF_MASTER_PATH)
+
+def _load_af_master() -> tuple:
+    """(索引, af_master_key)。CVデータが来て初めて読む（アップロード画面の表示では読まない）。
+    af_master_key はマスタ内容が変わったらキューブを作り直すためのキー。"""
+    stat = os.stat(AF_MASTER_PATH)
+    return _get_af_master(stat.st_mtime_ns, stat.st_size)
+
+# =====================
+# バックグラウンド集計パイプライン（アップロード単位の解析・事前集計をワーカーで実行）
+# =====================
+PIPELINE_WORKERS = 4
+PIPELINE_POLL_SEC = 0.5
+# コストレポートのシート並列解析に使うプロセス数
+COST_PARSE_PROCESSES = min(os.cpu_count() or 1, 8)
+
+class _PipelineJob:
+    """ステージ（名前, 表示名, 依存ステージ, 処理）を順に実行するジョブ。
+    処理は (これまでの結果, 計測レコード) を受け取り、ジョブが終わると None に置き換わる。各ステージの結果は results、例外は errors、
+    計測は trace に入る。依存先が失敗したステージは実行しない。
+    cancel() 後は次のステージに進まない（実行中のステージは最後まで走る）。"""
+    def __init__(self, key: tuple, stages: list):
+        self.key = key
+        self.stages = stages
+        self.status = {name: "pending" for name, _, _, _ in stages}
+        self.results = {}
+        self.errors = {}
+        self.trace = []
+        self.trace_logged = False
+        self._cancelled = threading.Event()
+        self._future = None
+
+    def start(self, pool: ThreadPoolExecutor):
+        self._future = pool.submit(self._run)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def done(self) -> bool:
+        return self._future is not None and self._future.done()
+
+    def _run(self):
+        try:
+            for name, _, deps, fn in self.stages:
+                if self._cancelled.is_set(): return
+                if any(d not in self.results for d in deps):
+                    self.status[name] = "skipped"
+                    continue
+                self.status[name] = "running"
+                meter = _StageMeter(name, [self.results[d] for d in deps])
+                try:
+                    with meter:
+                        self.results[name] = meter.output(fn(self.results, meter.record))
+                    self.status[name] = "done"
+                except Exception as e:
+                    self.errors[name] = e
+                    self.status[name] = "error"
+                finally:
+                    self.trace.append(meter.record)
+        finally:
+            # 処理はアップロードの生バイト列を抱えているので、終わったら手放す（セッションに残るのは結果だけ）
+            self.stages = [(name, label, deps, None) for name, label, deps, _ in self.stages]
+
+@st.cache_resource
+def _get_worker_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+def _process_pool_alive(pool: ProcessPoolExecutor) -> bool:
+    # ワーカーが落ちた（OOM など）プールは submit が BrokenProcessPool を投げる。その場合は作り直させる
+    # （壊れたままだと以降のアップロードがすべて逐次解析になる）
+    try:
+        pool.submit(int)
+    except BrokenProcessPool:
+        pool.shutdown(wait=False)
+        _emit_trace(_get_trace_logger(), "process_pool_rebuilt", workers=COST_PARSE_PROCESSES)
+        return False
+    return True
+
+@st.cache_resource(validate=_process_pool_alive)
+def _get_process_pool() -> ProcessPoolExecutor:
+    # サーバーはスレッドを持つため fork ではなく spawn でワーカーを起動する
+    return ProcessPoolExecutor(max_workers=COST_PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+def _pipeline_stages(cv_upload, cost_upload, af_master: pd.DataFrame, master_key: str,
+                     cache: _UploadCache, process_pool: ProcessPoolExecutor) -> list:
+    # cv_upload / cost_upload は (digest, bytes) または None。
+    # ワーカースレッドから st.cache_resource を呼ばないよう、キャッシュとプールは引数で受け取る
+    stages = []
+    if cv_upload is not None:
+        cv_digest, cv_bytes = cv_upload
+        stages += [
+            ("cv", "CVデータ読み込み", (), lambda r, t: cache.get_or_build(
+                ("cv", PARSER_VERSION, cv_digest, master_key), lambda: parse_cv(BytesIO(cv_bytes), af_master), t)),
+            ("cv_codes", "コード分類", ("cv",), lambda r, t: cache.get_or_build(
+                ("cv_codes", PARSER_VERSION, cv_digest, master_key), lambda: classify_codes(r["cv"].columns[1:], af_master), t)),
+            ("cv_cube", "CV日別集計", ("cv", "cv_codes"), lambda r, t: cache.get_or_build(
+                ("cv_cube", PARSER_VERSION, cv_digest, master_key), lambda: build_cv_cube(r["cv"], r["cv_codes"]), t)),
+            ("cv_trend", "CV推移（日・週・月）", ("cv_cube",), lambda r, t: cache.get_or_build(
+                ("cv_trend", PARSER_VERSION, cv_digest, master_key), lambda: cv_trend_tiers(r["cv_cube"]), t)),
+        ]
+    if cost_upload is not None:
+        cost_digest, cost_bytes = cost_upload
+        stages += [
+            ("cost_sheets", "コストレポート読み込み", (), lambda r, t: cache.get_or_build(
+                ("cost", PARSER_VERSION, cost_digest), lambda: load_cost_sheets(BytesIO(cost_bytes), executor=process_pool), t)),
+            ("cost_cube", "コスト日別集計", ("cost_sheets",), lambda r, t: cache.get_or_build(
+                ("cost_cube", PARSER_VERSION, cost_digest), lambda: build_cost_cube(r["cost_sheets"]), t)),
+            ("daily_cost", "日別Forecast/実績", ("cost_sheets",), lambda r, t: cache.get_or_build(
+                ("daily_cost", PARSER_VERSION, cost_digest), lambda: build_daily_cost_report_all_range(r["cost_sheets"]), t)),
+            ("daily_targets", "日別目標", ("cost_sheets",), lambda r, t: cache.get_or_build(
+                ("daily_targets", PARSER_VERSION, cost_digest), lambda: build_daily_targets_from_cost(r["cost_sheets"]), t)),
+            ("cost_trend", "Forecast/実績推移（日・週・月）", ("daily_cost",), lambda r, t: cache.get_or_build(
+                ("cost_trend", PARSER_VERSION, cost_digest), lambda: cost_trend_tiers(r["daily_cost"]), t)),
+            ("target_trend", "目標推移（日・週・月）", ("daily_targets",), lambda r, t: cache.get_or_build(
+                ("target_trend", PARSER_VERSION, cost_digest), lambda: target_trend_tiers(r["daily_targets"]), t)),
+        ]
+    return stages
+
+def _ensure_pipeline(cv_file, cost_file):
+    """入力に対応するジョブを返す。入力が変わっていれば実行中の古いジョブを取り消して新しく投入する。"""
+    cv_digest = _upload_digest(cv_file) if cv_file else None
+    cost_digest = _upload_digest(cost_file) if cost_file else None
+    af_master, af_master_key = _load_af_master() if cv_file else (None, None)
+    key = (cv_digest, cost_digest, af_master_key, PARSER_VERSION)
+    job = st.session_state.get("pipeline")
+    if job is not None and job.key == key:
+        return job
+    if job is not None:
+        job.cancel()
+    stages = _pipeline_stages(
+        (cv_digest, cv_file.getvalue()) if cv_file else None,
+        (cost_digest, cost_file.getvalue()) if cost_file else None,
+        af_master, af_master_key, _get_upload_cache(), _get_process_pool() if cost_file else None,
+    )
+    job = _PipelineJob(key, stages)
+    job.start(_get_worker_pool())
+    st.session_state["pipeline"] = job
+    return job
+
+def _render_pipeline_progress(job: _PipelineJob):
+    finished = sum(1 for v in job.status.values() if v != "pending" and v != "running")
+    current = next((label for name, label, _, _ in job.stages if job.status[name] == "running"), "待機中")
+    st.progress(finished / max(len(job.stages), 1), text=f"集計中… {current}（{finished}/{len(job.stages)}）")
+    marks = {"pending": "⬜", "running": "⏳", "done": "✅", "error": "❌", "skipped": "⏭️"}
+    st.caption("　".join(f"{marks[job.status[name]]} {label}" for name, label, _, _ in job.stages))
+
+# =====================
+# 履歴ストア（日別集計の蓄積。全セッション共有）
+# =====================
+HISTORY_DB_PATH = os.environ.get("CV_COST_HISTORY_DB", "history.sqlite3")
+
+@st.cache_resource
+def _get_history_store() -> HistoryStore:
+    return HistoryStore(HISTORY_DB_PATH)
+
+def _history_results(store: HistoryStore, dataset: str, key: tuple, stats: dict = None) -> dict:
+    """蓄積済みの全履歴から cv_cube / daily_allocation（日別シートの全期間）/ cost_cube / daily_cost /
+    daily_targets と各推移を組み立てる。
+    key に書き込み世代を含めるので、取り込みがあるまでは作り直さない。"""
+    def build():
+        out = {}
+        if store.has_series(dataset, CV_SERIES): out["cv_cube"] = store.cv_cube(dataset)
+        if store.has_series(dataset, ALLOC_SERIES): out["daily_allocation"] = store.daily_allocation(dataset)
+        if store.has_series(dataset, COST_SERIES): out["cost_cube"] = store.cost_cube(dataset)
+        if store.has_series(dataset, REPORT_SERIES): out["daily_cost"] = store.daily_cost_report(dataset)
+        if store.has_series(dataset, TARGET_SERIES): out["daily_targets"] = store.daily_targets(dataset)
+        out["cv_trend"] = cv_trend_tiers(out.get("cv_cube"))
+        out["cost_trend"] = cost_trend_tiers(out.get("daily_cost"))
+        out["target_trend"] = target_trend_tiers(out.get("daily_targets"))
+        return {k: v for k, v in out.items() if v is not None}
+    return _get_upload_cache().get_or_build(("history", PARSER_VERSION, *key), build, stats)
 
 # =====================
 # アップロード
 # =====================
+# この再実行で測った処理段（パイプラインの分は job.trace）
+rerun_trace = []
+
 st.header("📑 CV・配信費集計")
 col1, col2 = st.columns(2)
 with col1:
     cv_file = st.file_uploader("CVデータ", type="xlsx", key="cv")
 with col2:
     cost_file = st.file_uploader("コストレポート", type="xlsx", key="cost")
+# アップロード画面を出し終えるまでの時間（コールドスタートでは import を含む）
+first_paint_seconds = round(time.perf_counter() - _RERUN_T0, 4)
+
+# 解析・事前集計はバックグラウンドで実行し、終わるまで進捗を表示して待つ
+pipeline = _ensure_pipeline(cv_file, cost_file) if (cv_file or cost_file) else None
+if pipeline is not None and not pipeline.done:
+    _render_pipeline_progress(pipeline)
+    time.sleep(PIPELINE_POLL_SEC)
+    st.rerun()
+results = pipeline.results if pipeline is not None else {}
+errors = pipeline.errors if pipeline is not None else {}
+# 失敗したステージはすべて表示する（依存先の失敗で実行しなかった段は、その失敗の表示で分かる）
+for name, label, _, _ in (pipeline.stages if pipeline is not None else []):
+    if name in errors:
+        st.error(f"{label}の処理でエラーが発生しました: {errors[name]}")
+
+# =====================
+# 履歴ストア（任意。日別集計をデータセットごとに蓄積し、集計は蓄積済みの全履歴から行う）
+# =====================
+with st.sidebar:
+    use_history = st.toggle("履歴ストアに蓄積して集計する", value=False,
+                            help="アップロードの日別集計を蓄積し、過去のアップロード分も含めた履歴から期間集計します。")
+    history_dataset = st.text_input("データセット名", value="default", disabled=not use_history).strip() or "default"
+    st.toggle("処理時間を表示（デバッグ）", value=False, key="_show_trace",
+              help="処理段ごとの時間・メモリ・行列数・キャッシュ結果を表示します（ログには常に出力）。")
+
+history_key = None
+if use_history:
+    history_store = _get_history_store()
+    if pipeline is not None:
+        # 同じ入力は1回だけ取り込む（変わっていない月は読み飛ばし、値が変わった日だけ書き込む）
+        ingested = st.session_state.setdefault("_history_ingested", {})
+        if (history_dataset, pipeline.key) not in ingested:
+            ingested[(history_dataset, pipeline.key)] = _traced(
+                rerun_trace, "history_ingest", lambda: history_store.ingest_results(history_dataset, results))
+        st.sidebar.caption(f"今回のアップロードで追加・更新した行: {ingested[(history_dataset, pipeline.key)]:,}")
+    history_key = (HISTORY_DB_PATH, history_dataset, history_store.generation(history_dataset))
+    meter = _StageMeter("history_results")
+    with meter:
+        results = {**results, **meter.output(_history_results(history_store, history_dataset, history_key, meter.record))}
+    rerun_trace.append(meter.record)
 
 # =====================
 # 期間決定
@@ -76,20 +448,13 @@ with col2:
 default_start = date.today()
 default_end = date.today()
 
-def _safe_minmax_dates_from_cv(file):
-    try:
-        df = pd.read_excel(file, header=0, engine="openpyxl")
-        dt = pd.to_datetime(
-            df.iloc[:, 0], format="%Y%m%d", errors="coerce"
-        ).dropna()
-        if len(dt) > 0:
-            return dt.min().date(), dt.max().date()
-    except Exception:
-        pass
-    return None
-
-if cv_file:
-    mm = _safe_minmax_dates_from_cv(cv_file)
+cv_df = results.get("cv")
+if use_history and "cv_cube" in results and len(results["cv_cube"].dates) > 0:
+    # 履歴ストアで集計する時は、蓄積済みの CV の全期間を初期値にする（アップロードが無くても）
+    cube_dates = pd.DatetimeIndex(results["cv_cube"].dates)
+    default_start, default_end = cube_dates[0].date(), cube_dates[-1].date()
+elif cv_df is not None:
+    mm = cv_date_range(cv_df)
     if mm:
         default_start, default_end = mm
 
@@ -98,9 +463,10 @@ start_date, end_date = st.date_input(
     value=(default_start, default_end),
 )
 if start_date > end_date:
+    _report_rerun(pipeline, rerun_trace)
     st.stop()
 
-days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
+days = period_days(start_date, end_date)
 
 # =====================
 # CV集計（★修正箇所）
@@ -108,528 +474,286 @@ days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
 cv_result_base = None
 daily_allocation_df = None
 
-AFF_KEYS = ("GEN", "AFA", "AFP", "RAA")
-
-def is_affiliate(code: str) -> bool:
-    s = _norm_text(code).upper()
-    return any(k in s for k in AFF_KEYS)
-
-if cv_file:
-    df = pd.read_excel(cv_file, header=0, engine="openpyxl")
-    df["日付"] = pd.to_datetime(df.iloc[:, 0], format="%Y%m%d", errors="coerce")
-
-    filtered = df[
-        (df["日付"] >= pd.to_datetime(start_date)) &
-        (df["日付"] <= pd.to_datetime(end_date))
-    ]
-
-    mapping = af_df.set_index("AFコード")[["媒体", "分類"]].to_dict("index")
-    ad_codes = df.columns[1:]
-
-    rows = []
-
-    # ---- 合計CV ----
-    for code in ad_codes:
-        code_norm = _norm_text(code).upper()
-
-        if is_affiliate(code_norm):
-            media = category = "Affiliate"
-        elif code_norm in mapping:
-            media = mapping[code_norm]["媒体"]
-            category = mapping[code_norm]["分類"]
-        else:
-            continue
-
-        if "display" in category.lower():
-            continue
-
-        cv_sum = (
-            pd.to_numeric(filtered[code], errors="coerce")
-            .fillna(0).sum()
-        )
-
-        rows.append({
-            "分類": category,
-            "媒体": _alias_media(media),
-            "CV合計": cv_sum
-        })
-
-    if rows:
-        cv_result_base = (
-            pd.DataFrame(rows)
-            .groupby(["分類", "媒体"], as_index=False)["CV合計"]
-            .sum()
-        )
-        cv_result_base["CV日割り"] = (
-            cv_result_base["CV合計"] / days
-        ).round(2)
-
-    # ---- 日別CV ----
-    cv_long = filtered.melt(
-        id_vars=["日付"], var_name="コード", value_name="CV"
-    )
-    cv_long["CV"] = pd.to_numeric(
-        cv_long["CV"], errors="coerce"
-    ).fillna(0)
-    cv_long = cv_long[cv_long["CV"] > 0].copy()
-
-    cv_long["コード_norm"] = cv_long["コード"].apply(
-        lambda x: _norm_text(x).upper()
-    )
-
-    aff = cv_long[cv_long["コード_norm"].apply(is_affiliate)].copy()
-    aff["媒体"] = "Affiliate"
-    aff["分類"] = "Affiliate"
-
-    lst = cv_long[
-        ~cv_long["コード_norm"].apply(is_affiliate)
-    ].merge(
-        af_df[["AFコード", "媒体", "分類"]],
-        left_on="コード_norm",
-        right_on="AFコード",
-        how="inner",
-    )
-
-    merged = pd.concat([aff, lst], ignore_index=True)
-    merged = merged[
-        ~merged["分類"].astype(str).str.contains("display", case=False, na=False)
-    ]
-
-    daily_allocation_df = (
-        merged[["日付", "媒体", "分類", "CV"]]
-        .rename(columns={
-            "媒体": "割り振り",
-            "分類": "領域",
-            "CV": "合計値",
-        })
-    )
-
-    daily_allocation_df["日付"] = (
-        pd.to_datetime(daily_allocation_df["日付"]).dt.floor("D")
-    )
-    daily_allocation_df["割り振り"] = (
-        daily_allocation_df["割り振り"].apply(_alias_media)
-    )
-
-    daily_allocation_df = (
-        daily_allocation_df
-        .groupby(["日付", "割り振り"], as_index=False)
-        .agg(領域=("領域", "first"), 合計値=("合計値", "sum"))
-        .sort_values(["日付", "割り振り"])
-        .reset_index(drop=True)
-    )
+if "cv_cube" in results:
+    # ---- 合計CV（キューブの累積和から期間合計を取得）----
+    cv_result_base = _traced(rerun_trace, "cv_totals",
+                             lambda: cv_totals_for_period(results["cv_cube"], start_date, end_date), results["cv_cube"])
+
+    # ---- 日別CV（対象コード列だけを媒体ごとに列グループ合計。melt はしない）----
+    # 履歴ストアで集計する時は、蓄積済みの日別CVから期間内の行を取り出す
+    if "daily_allocation" in results:
+        alloc = results["daily_allocation"]
+        daily_allocation_df = _traced(rerun_trace, "daily_allocation", lambda: alloc[
+            (alloc["日付"] >= pd.Timestamp(start_date)) & (alloc["日付"] <= pd.Timestamp(end_date))
+        ].reset_index(drop=True), alloc)
+    elif cv_df is not None:
+        daily_allocation_df = _traced(rerun_trace, "daily_allocation", lambda: daily_cv_by_media(
+            filter_period(cv_df, start_date, end_date), results["cv_codes"]), cv_df)
+
+# コストレポート（バックグラウンドで1回だけ解析し、以降の集計で共有）
+cost_sheets = results.get("cost_sheets")
 
 # コスト集計（期間適用：領域別コンディション用）
-cost_summary = {
-    "Affiliate_total": 0.0, "Listing_total": 0.0,
-    "LS_Google単体": 0.0, "LS_Google単体以外": 0.0, "LS_Googleその他": 0.0,
-    "LS_Yahoo単体": 0.0, "LS_Yahoo単体以外": 0.0,
-    "LS_MS単体": 0.0, "LS_MS単体以外": 0.0,
-    "LS_Google単体→2025年11月よりMSその他": 0.0,
-    "LS_Yahoo単体（PSD）": 0.0,
-}
-if cost_file:
-    xls = pd.ExcelFile(cost_file)
-    target_sheets = [s for s in xls.sheet_names if ("listing" in s.lower()) or ("affiliate" in s.lower())]
-    listing_cols = {
-        "Listing_total": 17, "LS_Google単体": 53, "LS_Google単体以外": 89, "LS_Googleその他": 125,
-        "LS_Yahoo単体": 161, "LS_Yahoo単体以外": 197, "LS_MS単体": 233, "LS_MS単体以外": 269,
-    }
-    affiliate_cols = {"Affiliate_total": 20}
-    for sheet in target_sheets:
-        df = pd.read_excel(xls, sheet_name=sheet, engine="openpyxl")
-        sheet_type = "Listing" if "listing" in sheet.lower() else "Affiliate"
-        date_col_index = 1 if sheet_type == "Listing" else 0
-        df.iloc[:, date_col_index] = pd.to_datetime(df.iloc[:, date_col_index], errors="coerce")
-        filtered_df = df[(df.iloc[:, date_col_index] >= pd.to_datetime(start_date)) &
-                         (df.iloc[:, date_col_index] <= pd.to_datetime(end_date))].copy()
-        if sheet_type == "Listing":
-            for k, idx in listing_cols.items():
-                if idx < len(filtered_df.columns):
-                    cost_summary[k] += pd.to_numeric(filtered_df.iloc[:, idx], errors="coerce").fillna(0).sum()
-        if sheet_type == "Affiliate":
-            for k, idx in affiliate_cols.items():
-                if idx < len(filtered_df.columns):
-                    cost_summary[k] += pd.to_numeric(filtered_df.iloc[:, idx], errors="coerce").fillna(0).sum()
-    cost_summary["LS_Yahoo単体"] += cost_summary.get("LS_Yahoo単体（PSD）", 0.0)
-    cost_summary["LS_Yahoo単体（PSD）"] = 0.0
-
-# コストレポートから日別 Forecast/実績（全期間）
-daily_cost_df = None
-daily_cost_df_for_excel = None
-def _build_daily_cost_report_all_range(xls: pd.ExcelFile):
-    sheets = []
-    for s in xls.sheet_names:
-        sl = s.lower()
-        if "affiliate" in sl: sheets.append((s, "Affiliate"))
-        elif "listing" in sl: sheets.append((s, "Listing"))
-        elif "display" in sl and "nonifrs" not in sl: sheets.append((s, "Display"))
-    if not sheets: return None, None
-
-    col_idx = {
-        "Affiliate": {"date": 0, "actual_afcv": 3, "actual_cost": 20, "fc_afcv": 2, "fc_cost": 19},
-        "Listing":   {"date": 1, "actual_afcv": 18, "actual_cost": 17, "fc_afcv": 6, "fc_cost": 3},
-        "Display":   {"date": 1, "actual_afcv": 18, "actual_cost": 17, "fc_afcv": 6, "fc_cost": 3},
-    }
-
-    all_dates_collect = []
-    def _read_sheet_robust(sheet_name):
-        try: return pd.read_excel(xls, sheet_name=sheet_name, engine="openpyxl"), False
-        except Exception: pass
-        try: return pd.read_excel(xls, sheet_name=sheet_name, engine="openpyxl", header=None), True
-        except Exception: return None, False
-
-    for sheet_name, typ in sheets:
-        df0, used_header_none = _read_sheet_robust(sheet_name)
-        if df0 is None or df0.empty: continue
-        idxs = col_idx[typ]
-        if idxs["date"] >= len(df0.columns):
-            if not used_header_none:
-                df1, _ = _read_sheet_robust(sheet_name)
-                if df1 is None or idxs["date"] >= len(df1.columns): continue
-                df0 = df1
-            else:
-                continue
-        s_date0 = _coerce_date_series(df0.iloc[:, idxs["date"]]).dropna()
-        if not s_date0.empty:
-            all_dates_collect.extend(list(pd.to_datetime(s_date0).dt.floor("D")))
-    if not all_dates_collect: return None, None
-
-    global_min = min(all_dates_collect); global_max = max(all_dates_collect)
-    all_days = pd.date_range(global_min, global_max, freq="D")
-    def zero_series(): return pd.Series(0.0, index=all_days)
-
-    series_map = {
-        ("Forecast", "AFCV", "Listing"): zero_series(),
-        ("Forecast", "AFCV", "Display"): zero_series(),
-        ("Forecast", "AFCV", "Affiliate"): zero_series(),
-        ("Forecast", "配信費", "Listing"): zero_series(),
-        ("Forecast", "配信費", "Display"): zero_series(),
-        ("Forecast", "配信費", "Affiliate"): zero_series(),
-        ("実績", "AFCV", "Listing"): zero_series(),
-        ("実績", "AFCV", "Display"): zero_series(),
-        ("実績", "AFCV", "Affiliate"): zero_series(),
-        ("実績", "配信費", "Listing"): zero_series(),
-        ("実績", "配信費", "Display"): zero_series(),
-        ("実績", "配信費", "Affiliate"): zero_series(),
-    }
-
-    for sheet_name, typ in sheets:
-        df, used_header_none = _read_sheet_robust(sheet_name)
-        if df is None or df.empty: continue
-        idxs = col_idx[typ]
-        if idxs["date"] >= len(df.columns):
-            if not used_header_none:
-                df2, _ = _read_sheet_robust(sheet_name)
-                if df2 is None or idxs["date"] >= len(df2.columns): continue
-                df = df2
-            else:
-                continue
-        s_date = _coerce_date_series(df.iloc[:, idxs["date"]])
-        if s_date.dropna().empty: continue
-        def safe_num(col_i):
-            if col_i < len(df.columns):
-                return pd.to_numeric(df.iloc[:, col_i], errors="coerce").fillna(0.0)
-            return pd.Series(0.0, index=df.index)
-        s_fc_afcv = safe_num(idxs["fc_afcv"])
-        s_fc_cost = safe_num(idxs["fc_cost"])
-        s_ac_afcv = safe_num(idxs["actual_afcv"])
-        s_ac_cost = safe_num(idxs["actual_cost"])
-        if typ == "Affiliate":
-            s_ac_afcv = s_ac_afcv * 0.9
-
-        g = pd.DataFrame({
-            "_date": pd.to_datetime(s_date).dt.floor("D"),
-            "_fc_afcv": s_fc_afcv.values, "_fc_cost": s_fc_cost.values,
-            "_ac_afcv": s_ac_afcv.values, "_ac_cost": s_ac_cost.values,
-        })
-        g = g.dropna(subset=["_date"]).groupby("_date", as_index=True).sum()
-        g = g.reindex(all_days, fill_value=0.0)
-
-        series_map[("Forecast", "AFCV", typ)] += g["_fc_afcv"]
-        series_map[("Forecast", "配信費", typ)] += g["_fc_cost"]
-        series_map[("実績", "AFCV", typ)] += g["_ac_afcv"]
-        series_map[("実績", "配信費", typ)] += g["_ac_cost"]
-
-    order = [
-        ("Forecast", "AFCV", "Listing"), ("Forecast", "AFCV", "Display"), ("Forecast", "AFCV", "Affiliate"),
-        ("Forecast", "配信費", "Listing"), ("Forecast", "配信費", "Display"), ("Forecast", "配信費", "Affiliate"),
-        ("実績", "AFCV", "Listing"), ("実績", "AFCV", "Display"), ("実績", "AFCV", "Affiliate"),
-        ("実績", "配信費", "Listing"), ("実績", "配信費", "Display"), ("実績", "配信費", "Affiliate"),
-    ]
-    data_dict = {f"{k[0]}_{k[1]}_{k[2]}": series_map[k].astype(float) for k in order}
-    df_flat = pd.DataFrame(data_dict, index=series_map[("Forecast","AFCV","Listing")].index).reset_index()
-    df_flat.rename(columns={"index": "日付"}, inplace=True)
-    df_flat["日付"] = pd.to_datetime(df_flat["日付"]).dt.strftime("%Y/%m/%d")
-    return df_flat, df_flat.copy()
-
-# 目標（コストから日付一致で取得）
-def _build_daily_targets_from_cost(xls: pd.ExcelFile) -> pd.DataFrame:
-    listing_target_cols = {
-        "LS_Google単体": "AQ", "LS_Google単体以外": "CA", "LS_Googleその他": "DK",
-        "LS_Yahoo単体": "EU", "LS_Yahoo単体以外": "GE",
-        "LS_MS単体": "HO", "LS_MS単体以外": "IY",
-    }
-    display_target_cols = {"DS_Meta": "AQ", "DS_Yahoo": "EU", "DS_Google": "JA", "DS_Criteo": "KK"}
-    listing_idx_map = {k: _excel_col_to_idx(v) for k, v in listing_target_cols.items()}
-    display_idx_map = {k: _excel_col_to_idx(v) for k, v in display_target_cols.items()}
-
-    series_map = defaultdict(pd.Series)
-
-    def _read_sheet_robust(sheet_name):
-        try: return pd.read_excel(xls, sheet_name=sheet_name, engine="openpyxl"), False
-        except Exception: pass
-        try: return pd.read_excel(xls, sheet_name=sheet_name, engine="openpyxl", header=None), True
-        except Exception: return None, False
-
-    for s in xls.sheet_names:
-        sl = s.lower()
-        if "listing" in sl:
-            sheet_type = "Listing"
-        elif "display" in sl and "nonifrs" not in sl:
-            sheet_type = "Display"
-        else:
-            continue
-        df, used_header_none = _read_sheet_robust(s)
-        if df is None or df.empty: continue
-
-        date_col = 1  # B列
-        if date_col >= len(df.columns):
-            if not used_header_none:
-                df2, _ = _read_sheet_robust(s)
-                if df2 is None or date_col >= len(df2.columns): continue
-                df = df2
-            else:
-                continue
-
-        idx_map = listing_idx_map if sheet_type == "Listing" else display_idx_map
-        for label, col_idx in idx_map.items():
-            if col_idx >= len(df.columns): continue
-            tmp = pd.DataFrame({
-                "_date": _coerce_date_series(df.iloc[:, date_col]),
-                "_val": pd.to_numeric(df.iloc[:, col_idx], errors="coerce"),
-            })
-            tmp = tmp.dropna(subset=["_date"])
-            if tmp.empty: continue
-            tmp["_date"] = pd.to_datetime(tmp["_date"]).dt.floor("D")
-            tmp["_val"] = tmp["_val"].fillna(0.0)
-            g = tmp.groupby("_date", as_index=True)["_val"].sum()
-            if label in series_map and not series_map[label].empty:
-                series_map[label] = series_map[label].add(g, fill_value=0.0)
-            else:
-                series_map[label] = g
-
-    rows = []
-    for label, ser in series_map.items():
-        if ser is None or len(ser) == 0: continue
-        for dt, val in ser.items():
-            rows.append({"日付": pd.to_datetime(dt).floor("D"), "割り振り": label, "目標": float(val)})
-    if not rows:
-        return pd.DataFrame(columns=["日付", "割り振り", "目標"])
-    return pd.DataFrame(rows).sort_values(["日付", "割り振り"]).reset_index(drop=True)
+cost_summary = _traced(rerun_trace, "cost_summary", lambda: cost_summary_for_period(
+    results.get("cost_cube"), start_date, end_date
+), results.get("cost_cube"))
 
+# コストレポートから日別 Forecast/実績（全期間）。画面・Excel とも同じ表を使い、日付の書式は表示時に当てる
+daily_cost_df = None
 # 日別（全期間）プレビュー
-if cost_file:
-    try:
-        xls = pd.ExcelFile(cost_file)
-        daily_cost_df, daily_cost_df_for_excel = _build_daily_cost_report_all_range(xls)
+if cost_sheets is not None or "daily_cost" in results:
+    # 失敗時は上のエラー表示だけにする
+    if "daily_cost" not in errors:
+        daily_cost_df = results["daily_cost"]
         st.subheader("🗓️ コストレポート（日別・Forecast/実績）※AffのAFCV=*0.9、DisはnonIFRS除外")
         if daily_cost_df is not None and not daily_cost_df.empty:
-            st.dataframe(daily_cost_df, use_container_width=True)
+            st.dataframe(daily_cost_df, use_container_width=True,
+                         column_config={"日付": st.column_config.DateColumn(format="YYYY/MM/DD")})
         else:
             st.info("対象シートが見つからない、または日付列を解釈できませんでした。")
-    except Exception as e:
-        st.error(f"日別集計の処理でエラーが発生しました: {e}")
 
 # 領域別コンディション用テーブル
-final_df = None
-def _sum_cv(df, category_filter=None, media_in=None):
-    if df is None or len(df) == 0: return 0.0
-    tmp = df.copy(); tmp["媒体"] = tmp["媒体"].fillna("").astype(str)
-    if category_filter is not None:
-        tmp = tmp[tmp["分類"].astype(str) == category_filter]
-    if media_in is not None:
-        tmp = tmp[tmp["媒体"].isin(media_in)]
-    return float(pd.to_numeric(tmp["CV合計"], errors="coerce").fillna(0).sum())
-
-def _make_summary_rows(df):
-    google_medias = ["LS_Googleその他", "LS_Google単体", "LS_Google単体以外"]
-    yahoo_medias = ["", "LS_Yahoo単体", "LS_Yahoo単体以外"]
-    ms_medias = ["LS_MS単体", "LS_MS単体以外", "LS_Google単体→2025年11月よりMSその他"]
-    tan_medias = ["LS_Google単体", "LS_Yahoo単体", "LS_MS単体"]
-    brand_medias = ["LS_Google単体以外", "LS_Yahoo単体以外", "LS_MS単体以外"]
-    other_medias = ["LS_Google単体→2025年11月よりMSその他", "LS_Googleその他"]
-    rows = []
-    cv_all   = _sum_cv(df, category_filter="Affiliate") + _sum_cv(df, category_filter="Listing")
-    cv_sem   = _sum_cv(df, category_filter="Listing")
-    cv_google= _sum_cv(df, category_filter="Listing", media_in=google_medias)
-    cv_yahoo = _sum_cv(df, category_filter="Listing", media_in=yahoo_medias)
-    cv_ms    = _sum_cv(df, category_filter="Listing", media_in=ms_medias)
-    cv_tan   = _sum_cv(df, category_filter="Listing", media_in=tan_medias)
-    cv_brand = _sum_cv(df, category_filter="Listing", media_in=brand_medias)
-    cv_other = _sum_cv(df, category_filter="Listing", media_in=other_medias)
-    cost_all = cost_summary.get("Affiliate_total", 0.0) + cost_summary.get("Listing_total", 0.0)
-    cost_sem = cost_summary.get("Listing_total", 0.0)
-    cost_google = cost_summary.get("LS_Googleその他", 0.0) + cost_summary.get("LS_Google単体", 0.0) + cost_summary.get("LS_Google単体以外", 0.0)
-    cost_yahoo  = cost_summary.get("LS_Yahoo単体", 0.0) + cost_summary.get("LS_Yahoo単体以外", 0.0)
-    cost_ms     = cost_summary.get("LS_MS単体", 0.0) + cost_summary.get("LS_MS単体以外", 0.0)
-    cost_tan    = cost_summary.get("LS_Google単体", 0.0) + cost_summary.get("LS_Yahoo単体", 0.0) + cost_summary.get("LS_MS単体", 0.0)
-    cost_brand  = cost_summary.get("LS_Google単体以外", 0.0) + cost_summary.get("LS_Yahoo単体以外", 0.0) + cost_summary.get("LS_MS単体以外", 0.0)
-    cost_other  = cost_summary.get("LS_Googleその他", 0.0)
-    def add_row(name, cv_total, cost_total):
-        rows.append({"分類": name, "媒体": "", "CV合計": round(cv_total, 0),
-                     "CV日割り": round(cv_total / days, 2), "合計費用": round(cost_total, 0) if cost_file else ""})
-    add_row("ALL", cv_all, cost_all); add_row("SEM", cv_sem, cost_sem)
-    add_row("Google", cv_google, cost_google); add_row("Yahoo", cv_yahoo, cost_yahoo)
-    add_row("Microsoft", cv_ms, cost_ms); add_row("単体", cv_tan, cost_tan)
-    add_row("ブランド", cv_brand, cost_brand); add_row("その他", cv_other, cost_other)
-    return pd.DataFrame(rows)
-
-def _apply_cost_to_media_rows(base_df: pd.DataFrame) -> pd.DataFrame:
-    if base_df is None or len(base_df) == 0 or not cost_file: return base_df
-    media_cost_map = {
-        "Affiliate": cost_summary.get("Affiliate_total", 0.0),
-        "LS_Googleその他": cost_summary.get("LS_Googleその他", 0.0),
-        "LS_Google単体": cost_summary.get("LS_Google単体", 0.0),
-        "LS_Google単体以外": cost_summary.get("LS_Google単体以外", 0.0),
-        "LS_MS単体": cost_summary.get("LS_MS単体", 0.0),
-        "LS_MS単体以外": cost_summary.get("LS_MS単体以外", 0.0),
-        "LS_Yahoo単体": cost_summary.get("LS_Yahoo単体", 0.0),
-        "LS_Yahoo単体以外": cost_summary.get("LS_Yahoo単体以外", 0.0),
-    }
-    base_df = base_df.copy()
-    base_df["媒体_norm"] = base_df["媒体"].apply(_norm_text).apply(_alias_media)
-    def _pick_cost(media_norm: str):
-        if media_norm in media_cost_map: return round(float(media_cost_map[media_norm]), 0)
-        return ""
-    base_df["合計費用"] = base_df["媒体_norm"].apply(_pick_cost)
-    base_df.drop(columns=["媒体_norm"], inplace=True)
-    return base_df
-
-if cv_result_base is not None and len(cv_result_base) > 0:
-    base = cv_result_base.copy()
-    base["媒体"] = base["媒体"].apply(_alias_media)
-    base["合計費用"] = ""
-    base = _apply_cost_to_media_rows(base)
-    summary_rows = _make_summary_rows(base)
-    final_df = pd.concat([base, summary_rows], ignore_index=True)
+final_df = _traced(rerun_trace, "condition_table", lambda: build_condition_table(
+    # コストの日別集計が無い（未アップロード・失敗）なら 0 円ではなく空欄にする
+    cv_result_base, cost_summary, days, with_cost="cost_cube" in results))
 
 if final_df is not None and len(final_df) > 0:
     st.subheader("📤 領域別コンディション集計用テーブル（分類／媒体／CV合計／CV日割り／合計費用）— 期間適用")
     st.dataframe(final_df[["分類", "媒体", "CV合計", "CV日割り", "合計費用"]], use_container_width=True)
 
+# =====================
+# 推移グラフ（日・週・月の事前集計から、表示範囲の点数に応じて粒度を選んで描く）
+# =====================
+TREND_AREA_COLORS = {"Listing": "#1f77b4", "Display": "#ff7f0e", "Affiliate": "#2ca02c"}
+
+def _cost_trend_figure(frame: pd.DataFrame):
+    # plotly はグラフを描く時まで import しない（一度読めばプロセス内で使い回される）
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    # 上段 AFCV・下段 配信費。Forecast は点線、実績は実線
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.08, subplot_titles=("AFCV", "配信費"))
+    for col in frame.columns:
+        kind, metric, area = col.split("_")
+        fig.add_trace(go.Scatter(
+            x=frame.index, y=frame[col], name=f"{kind} {area}", legendgroup=f"{kind}_{area}",
+            showlegend=metric == "AFCV", mode="lines",
+            line={"color": TREND_AREA_COLORS[area], "dash": "dot" if kind == "Forecast" else "solid"},
+        ), row=1 if metric == "AFCV" else 2, col=1)
+    fig.update_layout(height=560, hovermode="x unified", margin={"t": 40, "b": 20})
+    return fig
+
+def _cv_target_figure(cv: pd.DataFrame, target: pd.DataFrame, media: list):
+    import plotly.graph_objects as go
+    from plotly.colors import qualitative
+    # 媒体ごとに CV を実線、目標を同じ色の点線で重ねる
+    fig = go.Figure()
+    for i, m in enumerate(media):
+        color = qualitative.Plotly[i % len(qualitative.Plotly)]
+        if cv is not None and m in cv.columns:
+            fig.add_trace(go.Scatter(x=cv.index, y=cv[m], name=f"{m} CV", legendgroup=m, mode="lines",
+                                     line={"color": color}))
+        if target is not None and m in target.columns:
+            fig.add_trace(go.Scatter(x=target.index, y=target[m], name=f"{m} 目標", legendgroup=m, mode="lines",
+                                     line={"color": color, "dash": "dot"}))
+    fig.update_layout(height=480, hovermode="x unified", margin={"t": 20, "b": 20})
+    return fig
+
+trend_tiers = {k: results[k] for k in ("cost_trend", "cv_trend", "target_trend") if results.get(k) is not None}
+if trend_tiers:
+    st.subheader("📈 推移（Forecast/実績・媒体別CVと目標）")
+    trend_first = min(t["日"].index.min() for t in trend_tiers.values()).date()
+    trend_last = max(t["日"].index.max() for t in trend_tiers.values()).date()
+    col_range, col_tier = st.columns([3, 1])
+    with col_tier:
+        tier_choice = st.radio("粒度", ["自動", *TREND_TIERS], horizontal=True,
+                               help="自動: 表示範囲の点数が多すぎない最も細かい粒度（日→週→月）")
+    with col_range:
+        if trend_first < trend_last:
+            view_start, view_end = st.slider("表示範囲", min_value=trend_first, max_value=trend_last,
+                                             value=(trend_first, trend_last), format="YYYY/MM/DD")
+        else:
+            view_start, view_end = trend_first, trend_last
+
+    def _trend_tier(*names) -> str:
+        # 同じグラフに重ねる系列は同じ粒度にそろえる（先にある方の点数で決める）
+        if tier_choice != "自動": return tier_choice
+        tiers = next(trend_tiers[n] for n in names if n in trend_tiers)
+        return pick_trend_tier(tiers, view_start, view_end)
+
+    def _trend_frame(name: str, tier: str):
+        if name not in trend_tiers: return None
+        return trend_slice(trend_tiers[name], tier, view_start, view_end)
+
+    tab_cost, tab_cv = st.tabs(["Forecast/実績", "媒体別CV・目標"])
+    with tab_cost:
+        if "cost_trend" not in trend_tiers:
+            st.info("コストレポートをアップロードすると表示されます。")
+        else:
+            tier = _trend_tier("cost_trend")
+            frame = _trend_frame("cost_trend", tier)
+            st.caption(f"粒度: {tier}（1系列 {len(frame):,} 点）")
+            st.plotly_chart(_cost_trend_figure(frame))
+    with tab_cv:
+        if "cv_trend" not in trend_tiers and "target_trend" not in trend_tiers:
+            st.info("CVデータまたはコストレポートをアップロードすると表示されます。")
+        else:
+            tier = _trend_tier("cv_trend", "target_trend")
+            cv_frame, target_frame = _trend_frame("cv_trend", tier), _trend_frame("target_trend", tier)
+            media = sorted(set(cv_frame.columns if cv_frame is not None else []) |
+                           set(target_frame.columns if target_frame is not None else []))
+            # 既定は目標のある媒体（目標がなければ全媒体）
+            default_media = list(target_frame.columns) if target_frame is not None else media
+            selected = st.multiselect("媒体", media, default=default_media)
+            n_points = max(len(f) for f in (cv_frame, target_frame) if f is not None)
+            st.caption(f"粒度: {tier}（1系列 最大 {n_points:,} 点）")
+            st.plotly_chart(_cv_target_figure(cv_frame, target_frame, selected))
+
+# =====================
+# Excel出力（ダウンロードされた時だけ生成し、一時ファイルにスプールして再利用）
+# =====================
+EXPORT_SPOOL_MAX_FILES = 16
+
+class _ExportSpool:
+    """生成済みエクスポートファイルのパスをキーごとに保持する LRU。
+    上限を超えたら古い順にファイルごと削除する。全セッション共有。"""
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.dir = tempfile.mkdtemp(prefix="cv_cost_export_")
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, writer, suffix: str, stats: dict = None) -> str:
+        with self._lock:
+            path = self._paths.get(key)
+            if path is not None and os.path.exists(path):
+                self._paths.move_to_end(key)
+                if stats is not None: stats["cache"] = "hit"
+                return path
+        if stats is not None: stats["cache"] = "miss"
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.dir)
+        os.close(fd)
+        try:
+            writer(path)
+        except BaseException:
+            os.remove(path)
+            raise
+        with self._lock:
+            if key in self._paths and os.path.exists(self._paths[key]):
+                # 同じキーを別スレッドが先に書き終えていたらそちらを使う
+                os.remove(path)
+                return self._paths[key]
+            self._paths[key] = path
+            while len(self._paths) > self.max_files:
+                _, old_path = self._paths.popitem(last=False)
+                if os.path.exists(old_path): os.remove(old_path)
+        return path
+
+@st.cache_resource
+def _get_export_spool() -> _ExportSpool:
+    return _ExportSpool(EXPORT_SPOOL_MAX_FILES)
+
+def _spooled_download(spool: _ExportSpool, key: tuple, writer, suffix: str, logger: logging.Logger) -> bytes:
+    """download_button の data に渡す（クリックされた時だけ、別スレッドで呼ばれるので st.* は使わない）。"""
+    meter = _StageMeter(f"export{suffix}")
+    try:
+        with meter:
+            path = spool.get_or_build(key, writer, suffix, meter.record)
+            with open(path, "rb") as f:
+                data = f.read()
+        meter.record["bytes"] = len(data)
+        return data
+    finally:
+        _emit_trace(logger, "export", **meter.record)
+
+# 出力形式の表示名 → (EXPORT_FORMATS のキー, MIME タイプ)。Parquet / CSV は1表1ファイルの zip
+EXPORT_FORMAT_CHOICES = {
+    "Excel（xlsx）": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet（zip）": ("parquet", "application/zip"),
+    "CSV gzip（zip）": ("csv", "application/zip"),
+}
+
 # Excel出力（申込件数=期間適用 / コストレポート日別=全期間 / 日別=期間適用）
 if (final_df is not None and len(final_df) > 0) or \
-   (daily_cost_df_for_excel is not None and not daily_cost_df_for_excel.empty) or \
+   (daily_cost_df is not None and not daily_cost_df.empty) or \
    (daily_allocation_df is not None and len(daily_allocation_df) > 0):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        workbook = writer.book
-
-        # 1) 申込件数
-        if final_df is not None and len(final_df) > 0:
-            final_df.to_excel(writer, index=False, sheet_name="申込件数")
-            ws = writer.sheets["申込件数"]
-            ws.write(0, 6, "集計期間"); ws.write(0, 7, f"{start_date} ～ {end_date}")
-            ws.write(1, 6, "集計日数"); ws.write(1, 7, days)
-
-        # 2) 日別（yyyy/m/d で確実に出力）
-        if daily_allocation_df is not None and len(daily_allocation_df) > 0:
-            df_day = daily_allocation_df.copy()
-            # 目標の突合
-            if cost_file:
-                try:
-                    xls2 = pd.ExcelFile(cost_file)
-                    daily_targets = _build_daily_targets_from_cost(xls2)
-                    if not daily_targets.empty:
-                        mask_period = (daily_targets["日付"] >= pd.to_datetime(start_date)) & \
-                                      (daily_targets["日付"] <= pd.to_datetime(end_date))
-                        daily_targets = daily_targets.loc[mask_period].copy()
-                        df_day = df_day.merge(daily_targets, on=["日付", "割り振り"], how="left")
-                    else:
-                        df_day["目標"] = np.nan
-                except Exception as e:
-                    st.warning(f"『目標』値の取得でエラーが発生しました: {e}")
-                    df_day["目標"] = np.nan
-            else:
-                df_day["目標"] = np.nan
-
-            # 日付をdatetimeに統一
-            df_day["日付"] = pd.to_datetime(df_day["日付"]).dt.floor("D")
-
-            # FIX: date_format引数は使わない（環境で未対応なためTypeErrorになる）
-            df_day.to_excel(writer, index=False, sheet_name="日別")  # ← ここからdate_formatを削除
-            ws_day = writer.sheets["日別"]
-
-            # 書式
-            fmt_date_day = workbook.add_format({"num_format": "yyyy/m/d", "align": "center"})
-            fmt_num_int  = workbook.add_format({"num_format": "#,##0", "align": "right"})
-            fmt_num_f2   = workbook.add_format({"num_format": "#,##0.00", "align": "right"})
-
-            # 列幅
-            ws_day.set_column(0, 0, 12)              # A:日付
-            ws_day.set_column(1, 1, 24)              # B:割り振り
-            ws_day.set_column(2, 2, 16)              # C:領域
-            ws_day.set_column(3, 3, 12, fmt_num_int) # D:合計値
-            ws_day.set_column(4, 4, 14, fmt_num_f2)  # E:目標
-
-            # ★A列を datetime 書式で上書き（確実に yyyy/m/d へ）
-            start_row = 1  # ヘッダー行を除く
-            for i, dt_val in enumerate(df_day["日付"], start=start_row):
-                if pd.isna(dt_val): 
-                    continue
-                ws_day.write_datetime(i, 0, pd.to_datetime(dt_val), fmt_date_day)
-
-        # 3) コストレポート日別（全期間）※日付も yyyy/m/d に統一
-        if daily_cost_df_for_excel is not None and not daily_cost_df_for_excel.empty:
-            ws2 = workbook.add_worksheet("コストレポート日別")
-            writer.sheets["コストレポート日別"] = ws2
-            fmt_center = workbook.add_format({"align": "center", "valign": "vcenter", "border": 1})
-            fmt_date = workbook.add_format({"num_format": "yyyy/m/d", "border": 1, "align": "center"})
-            fmt_num = workbook.add_format({"num_format": "#,##0.00", "border": 1})
-
-            ws2.merge_range(0, 0, 2, 0, "日付", fmt_center)
-            ws2.merge_range(0, 1, 0, 6, "Forecast", fmt_center)
-            ws2.merge_range(0, 7, 0, 12, "実績", fmt_center)
-            ws2.merge_range(1, 1, 1, 3, "AFCV", fmt_center)
-            ws2.merge_range(1, 4, 1, 6, "配信費", fmt_center)
-            ws2.merge_range(1, 7, 1, 9, "AFCV", fmt_center)
-            ws2.merge_range(1, 10, 1, 12, "配信費", fmt_center)
-
-            headers_level3 = ["Listing", "Display", "Affiliate"]
-            for i, h in enumerate(headers_level3):
-                ws2.write(2, 1 + i, h, fmt_center)
-                ws2.write(2, 4 + i, h, fmt_center)
-                ws2.write(2, 7 + i, h, fmt_center)
-                ws2.write(2, 10 + i, h, fmt_center)
-
-            ws2.set_column(0, 0, 12)   # 日付
-            ws2.set_column(1, 12, 14)  # 値
-
-            order_cols = [
-                "Forecast_AFCV_Listing", "Forecast_AFCV_Display", "Forecast_AFCV_Affiliate",
-                "Forecast_配信費_Listing", "Forecast_配信費_Display", "Forecast_配信費_Affiliate",
-                "実績_AFCV_Listing", "実績_AFCV_Display", "実績_AFCV_Affiliate",
-                "実績_配信費_Listing", "実績_配信費_Display", "実績_配信費_Affiliate",
-            ]
-            dfw = daily_cost_df_for_excel.copy()
-            dfw["日付"] = pd.to_datetime(dfw["日付"], format="%Y/%m/%d")
-
-            start_row = 3
-            for r, (_, row) in enumerate(dfw.iterrows(), start=start_row):
-                ws2.write_datetime(r, 0, row["日付"], fmt_date)
-                for c, col in enumerate(order_cols, start=1):
-                    val = float(row.get(col, 0.0))
-                    ws2.write_number(r, c, val, fmt_num)
-
-            ws2.write(0, 14, "備考")
-            ws2.write(0, 15, "全期間集計（読み込み可能な最小～最大日付）")
-
+    # 目標（日別シート用）。取得エラーは上で表示済みで、その場合は目標なしで出力する
+    daily_targets = None
+    if daily_allocation_df is not None and len(daily_allocation_df) > 0:
+        daily_targets = results.get("daily_targets")
+
+    # Parquet / CSV は書式なしで同じ3表を出す（集計に取り込む側はこちらを使えば xlsx の解析が要らない）
+    export_format, export_mime = EXPORT_FORMAT_CHOICES[st.radio(
+        "出力形式", list(EXPORT_FORMAT_CHOICES), horizontal=True,
+        help="Parquet / CSV は申込件数・日別・コストレポート日別を1表1ファイルにして zip でまとめます。")]
+    export_fn, export_suffix = EXPORT_FORMATS[export_format]
+
+    # 再実行ごとには作らない。キー（入力ハッシュ・期間・形式）ごとに初回ダウンロード時だけ生成する
+    export_key = (pipeline.key if pipeline is not None else None, history_key, start_date, end_date, export_format)
+    export_writer = partial(
+        export_fn,
+        final_df=final_df, daily_allocation_df=daily_allocation_df, daily_targets=daily_targets,
+        daily_cost_df=daily_cost_df, start_date=start_date, end_date=end_date, days=days,
+    )
     st.download_button(
         "📥 集計結果をダウンロード",
-        data=output.getvalue(),
-        file_name=f"集計結果_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        data=partial(_spooled_download, _get_export_spool(), export_key, export_writer, export_suffix, _get_trace_logger()),
+        file_name=f"集計結果_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}{export_suffix}",
+        mime=export_mime
     )
 else:
     st.info("📌 集計が完了するとダウンロードボタンが表示されます。")
+
+# =====================
+# 期間比較（月ごと・週ごと・指定した期間の領域別コンディション表を横に並べる）
+# =====================
+COMPARE_MAX_PERIODS = 60
+
+def _parse_compare_periods(text: str) -> tuple:
+    """1行1期間（YYYY-MM-DD:YYYY-MM-DD）を [(開始日, 終了日), ...] と読めなかった行のリストにする。"""
+    periods, bad = [], []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line: continue
+        try:
+            s, e = (date.fromisoformat(x.strip()) for x in line.split(":"))
+        except ValueError:
+            bad.append(line); continue
+        if s > e: bad.append(line); continue
+        periods.append((s, e))
+    return periods, bad
+
+if "cv_cube" in results:
+    st.subheader("📊 期間比較（領域別コンディション集計用テーブルを期間ごとに横並び）")
+    if st.toggle("複数の期間を並べて比較する", value=False, key="compare_periods"):
+        compare_unit = st.radio("期間の区切り", ["月ごと", "週ごと", "期間を指定"], horizontal=True,
+                                help="月ごと・週ごと（月曜始まり）は上の集計期間を区切ります。")
+        if compare_unit == "期間を指定":
+            periods, bad_lines = _parse_compare_periods(st.text_area(
+                "比較する期間（1行に1期間、YYYY-MM-DD:YYYY-MM-DD）", value=f"{start_date}:{end_date}"))
+            if bad_lines:
+                st.warning("読めなかった行: " + " / ".join(bad_lines))
+        else:
+            periods = split_periods(start_date, end_date, "月" if compare_unit == "月ごと" else "週")
+        if len(periods) > COMPARE_MAX_PERIODS:
+            st.warning(f"期間が多すぎるため先頭の {COMPARE_MAX_PERIODS} 期間だけを比較します。")
+            periods = periods[:COMPARE_MAX_PERIODS]
+
+        compare_df = _traced(rerun_trace, "period_comparison", lambda: build_period_comparison(
+            results["cv_cube"], results.get("cost_cube"), periods,
+            with_cost="cost_cube" in results), results["cv_cube"])
+        if compare_df is not None and len(compare_df) > 0:
+            view = compare_df.copy()
+            view.columns = [f"{p} {m}".strip() for p, m in compare_df.columns]
+            st.dataframe(view, use_container_width=True)
+            compare_key = (pipeline.key if pipeline is not None else None, history_key, tuple(periods), "compare.xlsx")
+            st.download_button(
+                "📥 期間比較をダウンロード",
+                data=partial(_spooled_download, _get_export_spool(), compare_key,
+                             partial(write_comparison_workbook, table=compare_df), ".xlsx", _get_trace_logger()),
+                file_name=f"期間比較_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            st.info("比較する期間がありません。")
+
+_report_rerun(pipeline, rerun_trace, period=[start_date, end_date])
@@ -0,0 +1,1302 @@
+"""期間中CV・配信費集計の読み込み・分類処理（Streamlit に依存しない部分）。
+
+コストレポートのシート解析はプロセスプールで並列に実行できるよう、
+ワーカーから import できるこのモジュールに置く。
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from array import array
+from itertools import chain, islice
+from io import BytesIO
+from datetime import datetime
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype as is_dt
+
+# =====================
+# ユーティリティ
+# =====================
+def norm_text(x) -> str:
+    if x is None:
+        return ""
+    return str(x).replace("\r", "").replace("\n", "").strip()
+
+MEDIA_ALIAS = {
+    "LS_Yahoo単体（PSD）": "LS_Yahoo単体",
+}
+def alias_media(media: str) -> str:
+    m = norm_text(media)
+    return MEDIA_ALIAS.get(m, m)
+
+def excel_col_to_idx(col: str) -> int:
+    col = norm_text(col).upper()
+    idx = 0
+    for ch in col:
+        if "A" <= ch <= "Z":
+            idx = idx * 26 + (ord(ch) - ord("A") + 1)
+    return idx - 1
+
+# =====================
+# 日付列の解釈（列ごとに形式を1回判定し、重複を除いた値だけを固定書式で変換。列の内容ごとにキャッシュ）
+# =====================
+# 文字列の日付として試す書式（すべての日付文字列がどれか1つに合えばその書式で一括変換）
+DATE_STRING_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+DATE_CACHE_MAX_ENTRIES = 64
+EXCEL_SERIAL_EPOCH = pd.Timestamp("1899-12-30")
+
+_date_cache = OrderedDict()
+_date_cache_lock = threading.Lock()
+
+def _coerce_dates_mixed(values: pd.Series) -> pd.Series:
+    """形式が混在する値の解釈（数値は 1899-12-30 起点のシリアル値、それ以外は書式を推測）。"""
+    s2 = values.copy()
+    num = pd.to_numeric(s2, errors="coerce")
+    num_mask = num.notna()
+    if num_mask.any():
+        s2.loc[num_mask] = pd.to_timedelta(num[num_mask], unit="D") + EXCEL_SERIAL_EPOCH
+    return pd.to_datetime(s2, errors="coerce")
+
+def _string_date_format(strings: list):
+    """日付文字列が共通に従う書式。数字を含まない文字列（「合計」など）は日付ではないので除く。
+    すべて日付でなければ ""、1つの書式にまとまらなければ None（混在扱い）。"""
+    dated = [v for v in strings if any(ch.isdigit() for ch in v)]
+    if any(v.strip().lower() in ("now", "today") for v in strings): return None
+    if not dated: return ""
+    for fmt in DATE_STRING_FORMATS:
+        if pd.to_datetime(pd.Series(dated, dtype=object), format=fmt, errors="coerce").notna().all():
+            return fmt
+    return None
+
+def detect_date_encoding(uniques: pd.Series) -> str:
+    """値の種類から列の日付形式を判定する: "datetime" / "serial" / 書式文字列（文字列日付）/ "mixed"。
+    シリアル値と日付セル・文字列日付が同じ列に混ざる場合は、文字列側の書式が決まれば書式文字列を返す。"""
+    kinds = set()
+    strings = []
+    for v in uniques:
+        if isinstance(v, (datetime, np.datetime64)): kinds.add("datetime")
+        elif isinstance(v, (int, float, np.number)) and not isinstance(v, bool): kinds.add("serial")
+        elif isinstance(v, str):
+            if pd.notna(pd.to_numeric(v, errors="coerce")): kinds.add("serial")
+            else: strings.append(v)
+        else: return "mixed"
+    if not strings: return "serial" if "serial" in kinds else "datetime"
+    fmt = _string_date_format(strings)
+    return "mixed" if fmt is None else fmt
+
+def _decode_date_uniques(uniques: pd.Series, encoding: str) -> np.ndarray:
+    """重複を除いた値（出現順）を datetime64[ns] にする。"""
+    if encoding == "yyyymmdd":
+        return pd.to_datetime(uniques, format="%Y%m%d", errors="coerce").to_numpy("datetime64[ns]")
+    if encoding == "auto":
+        encoding = detect_date_encoding(uniques)
+    if encoding == "mixed":
+        return _coerce_dates_mixed(uniques).to_numpy("datetime64[ns]")
+    out = np.full(len(uniques), np.datetime64("NaT"), dtype="datetime64[ns]")
+    is_dt_value = uniques.map(lambda v: isinstance(v, (datetime, np.datetime64))).to_numpy(dtype=bool)
+    if is_dt_value.any():
+        out[is_dt_value] = pd.to_datetime(uniques[is_dt_value]).to_numpy("datetime64[ns]")
+    num = pd.to_numeric(uniques.where(~is_dt_value), errors="coerce")
+    is_num = num.notna().to_numpy()
+    if is_num.any():
+        out[is_num] = (pd.to_timedelta(num[is_num], unit="D") + EXCEL_SERIAL_EPOCH).to_numpy("datetime64[ns]")
+    is_str = ~(is_dt_value | is_num)
+    if encoding not in ("datetime", "serial", "") and is_str.any():
+        out[is_str] = pd.to_datetime(uniques[is_str], format=encoding, errors="coerce").to_numpy("datetime64[ns]")
+    return out
+
+def coerce_date_series(s: pd.Series, encoding: str = "auto") -> pd.Series:
+    """日付列を datetime64 にする。encoding="auto" は Excel のシリアル値・日付セル・日付文字列の混在を、
+    "yyyymmdd" は 20250901 形式（CVデータのA列）を解釈する。解釈できない値は NaT。
+    重複を除いた値の並びが同じ列は、2回目以降その変換結果をキャッシュから引く。"""
+    if s is None:
+        return pd.Series(dtype="datetime64[ns]")
+    if is_dt(s):
+        return s
+    codes, uniques = pd.factorize(s.to_numpy(dtype=object), use_na_sentinel=True)
+    # 型も区別するよう repr で指紋を取る（重複を除いた後なので日数程度の長さ）
+    key = (encoding, hashlib.sha1(repr(uniques.tolist()).encode()).hexdigest())
+    with _date_cache_lock:
+        table = _date_cache.get(key)
+        if table is not None: _date_cache.move_to_end(key)
+    if table is None:
+        # 欠損（コード -1）は末尾に足した NaT を引く
+        table = np.append(_decode_date_uniques(pd.Series(uniques, dtype=object), encoding), np.datetime64("NaT"))
+        with _date_cache_lock:
+            _date_cache[key] = table
+            while len(_date_cache) > DATE_CACHE_MAX_ENTRIES: _date_cache.popitem(last=False)
+    return pd.Series(table[codes], index=s.index, name=s.name)
+
+# =====================
+# xlsx ストリーミング読み込み（シートXMLを1行ずつ解析し、必要な列だけ値を取り出す）
+# =====================
+_XL_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XL_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def _xlsx_sheet_paths(zf: zipfile.ZipFile) -> list:
+    """[(シート名, ZIP内パス)] をブックのシート順で返す。"""
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {r.get("Id"): r.get("Target") for r in rels.iter(f"{_PKG_REL_NS}Relationship")}
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    out = []
+    for sh in wb.iter(f"{_XL_NS}sheet"):
+        target = targets[sh.get(f"{_XL_REL_NS}id")]
+        path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+        out.append((sh.get("name"), path))
+    return out
+
+def _xlsx_text(elem) -> str:
+    # リッチテキストは連結、ふりがな（rPh）は除外
+    if elem is None: return ""
+    t = elem.find(f"{_XL_NS}t")
+    if t is not None: return t.text or ""
+    return "".join((r.findtext(f"{_XL_NS}t") or "") for r in elem.findall(f"{_XL_NS}r"))
+
+def _xlsx_shared_strings(zf: zipfile.ZipFile) -> list:
+    if "xl/sharedStrings.xml" not in zf.namelist(): return []
+    out = []
+    for _, elem in ET.iterparse(zf.open("xl/sharedStrings.xml")):
+        if elem.tag == f"{_XL_NS}si":
+            out.append(_xlsx_text(elem))
+            elem.clear()
+    return out
+
+def _xlsx_date_styles(zf: zipfile.ZipFile) -> frozenset:
+    # 日付書式が割り当てられたセルスタイル番号（cellXfs の位置）
+    # openpyxl は読み込みに時間がかかるので、ブックを初めて開く時まで import しない
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+    if "xl/styles.xml" not in zf.namelist(): return frozenset()
+    styles = ET.fromstring(zf.read("xl/styles.xml"))
+    custom = {int(f.get("numFmtId")): f.get("formatCode", "") for f in styles.iter(f"{_XL_NS}numFmt")}
+    xfs = styles.find(f"{_XL_NS}cellXfs")
+    out = set()
+    for i, xf in enumerate(xfs if xfs is not None else []):
+        fmt_id = int(xf.get("numFmtId", 0))
+        code = custom.get(fmt_id, BUILTIN_FORMATS.get(fmt_id, ""))
+        if code and is_date_format(code): out.add(i)
+    return frozenset(out)
+
+def _xlsx_open(zf: zipfile.ZipFile) -> dict:
+    """ブック単位の情報（シート一覧・共有文字列・日付書式スタイル・日付の基準日）を読む。"""
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    pr = wb.find(f"{_XL_NS}workbookPr")
+    date1904 = pr is not None and pr.get("date1904") in ("1", "true")
+    return {
+        "sheets": _xlsx_sheet_paths(zf),
+        "shared": _xlsx_shared_strings(zf),
+        "date_styles": _xlsx_date_styles(zf),
+        "epoch": pd.Timestamp("1904-01-01") if date1904 else pd.Timestamp("1899-12-30"),
+    }
+
+def _xlsx_number(text: str):
+    if text is None: return None
+    if "." in text or "E" in text or "e" in text: return float(text)
+    return int(text)
+
+def _xlsx_iter_rows(zf: zipfile.ZipFile, book: dict, path: str, cols=None, stats=None):
+    """シートの各行を (行番号(1始まり), {列番号(0始まり): 値}) で返す。値のない行は返さない。
+    cols 指定時はその列以外の値を解釈しない。stats を渡すと全セルの最大列数を ncols に記録する。
+    数値は int/float（日付書式のセルは Timestamp）、文字列は str、真偽値は bool、エラー値は None。"""
+    tag_row, tag_c, tag_v, tag_is = f"{_XL_NS}row", f"{_XL_NS}c", f"{_XL_NS}v", f"{_XL_NS}is"
+    shared, date_styles, epoch = book["shared"], book["date_styles"], book["epoch"]
+    sheet_data = None
+    rownum = 0
+    ncols = 0
+    for event, elem in ET.iterparse(zf.open(path), events=("start", "end")):
+        if event == "start":
+            if elem.tag == f"{_XL_NS}sheetData": sheet_data = elem
+            continue
+        if elem.tag != tag_row: continue
+        rownum = int(elem.get("r")) if elem.get("r") else rownum + 1
+        values = {}
+        pos = -1
+        for c in elem.iter(tag_c):
+            ref = c.get("r")
+            pos = excel_col_to_idx(ref) if ref else pos + 1
+            if pos >= ncols: ncols = pos + 1
+            if cols is not None and pos not in cols: continue
+            t = c.get("t", "n")
+            if t == "inlineStr":
+                values[pos] = _xlsx_text(c.find(tag_is))
+                continue
+            v = c.findtext(tag_v)
+            if v is None: continue
+            if t == "s": values[pos] = shared[int(v)]
+            elif t == "n":
+                num = _xlsx_number(v)
+                if date_styles and int(c.get("s", 0)) in date_styles:
+                    num = epoch + pd.to_timedelta(num, unit="D")
+                values[pos] = num
+            elif t == "b": values[pos] = v == "1"
+            elif t == "e": values[pos] = None
+            elif t == "d": values[pos] = pd.Timestamp(v)
+            else: values[pos] = v
+        if sheet_data is not None: sheet_data.remove(elem)
+        elem.clear()
+        if stats is not None: stats["ncols"] = ncols
+        if values: yield rownum, values
+
+def _xlsx_float(v) -> float:
+    # 数値列の値を float に（文字列は数値として解釈できれば採用、それ以外は NaN）
+    if isinstance(v, (int, float)): return float(v)
+    if isinstance(v, str):
+        num = pd.to_numeric(v, errors="coerce")
+        return float(num) if isinstance(num, (int, float, np.number)) else np.nan
+    return np.nan
+
+def _header_labels(header: dict, ncols: int) -> list:
+    # pandas の header=0 と同じ列名（空欄は Unnamed: n、重複は .1, .2 …）
+    labels, seen = [], defaultdict(int)
+    for i in range(ncols):
+        v = header.get(i)
+        label = f"Unnamed: {i}" if v is None or v == "" else v
+        if label in seen:
+            n = seen[label]
+            while f"{label}.{n}" in seen: n += 1
+            seen[label] = n + 1
+            label = f"{label}.{n}"
+        seen[label] += 1
+        labels.append(label)
+    return labels
+
+# =====================
+# コストレポートの列定義（シート種別ごとに参照する列。0始まりの列番号）
+# =====================
+LISTING_COST_COLS = {
+    "Listing_total": 17, "LS_Google単体": 53, "LS_Google単体以外": 89, "LS_Googleその他": 125,
+    "LS_Yahoo単体": 161, "LS_Yahoo単体以外": 197, "LS_MS単体": 233, "LS_MS単体以外": 269,
+}
+AFFILIATE_COST_COLS = {"Affiliate_total": 20}
+DAILY_COST_COLS = {
+    "Affiliate": {"date": 0, "actual_afcv": 3, "actual_cost": 20, "fc_afcv": 2, "fc_cost": 19},
+    "Listing":   {"date": 1, "actual_afcv": 18, "actual_cost": 17, "fc_afcv": 6, "fc_cost": 3},
+    "Display":   {"date": 1, "actual_afcv": 18, "actual_cost": 17, "fc_afcv": 6, "fc_cost": 3},
+}
+LISTING_TARGET_COLS = {
+    "LS_Google単体": "AQ", "LS_Google単体以外": "CA", "LS_Googleその他": "DK",
+    "LS_Yahoo単体": "EU", "LS_Yahoo単体以外": "GE",
+    "LS_MS単体": "HO", "LS_MS単体以外": "IY",
+}
+DISPLAY_TARGET_COLS = {"DS_Meta": "AQ", "DS_Yahoo": "EU", "DS_Google": "JA", "DS_Criteo": "KK"}
+
+COST_SHEET_SPEC = {
+    "Listing": {
+        "date": [DAILY_COST_COLS["Listing"]["date"]],
+        "values": sorted(
+            set(LISTING_COST_COLS.values())
+            | {i for k, i in DAILY_COST_COLS["Listing"].items() if k != "date"}
+            | {excel_col_to_idx(c) for c in LISTING_TARGET_COLS.values()}
+        ),
+    },
+    "Affiliate": {
+        "date": [DAILY_COST_COLS["Affiliate"]["date"]],
+        "values": sorted(
+            set(AFFILIATE_COST_COLS.values())
+            | {i for k, i in DAILY_COST_COLS["Affiliate"].items() if k != "date"}
+        ),
+    },
+    "Display": {
+        "date": [DAILY_COST_COLS["Display"]["date"]],
+        "values": sorted(
+            {i for k, i in DAILY_COST_COLS["Display"].items() if k != "date"}
+            | {excel_col_to_idx(c) for c in DISPLAY_TARGET_COLS.values()}
+        ),
+    },
+}
+
+def cost_sheet_types(sheet_name: str) -> list:
+    # 集計ごとに判定順が異なるため、名前が該当する種別をすべて返す
+    sl = sheet_name.lower()
+    types = []
+    if "listing" in sl: types.append("Listing")
+    if "affiliate" in sl: types.append("Affiliate")
+    if "display" in sl and "nonifrs" not in sl: types.append("Display")
+    return types
+
+# =====================
+# シートのレイアウト（見出し行を先頭行から決め、同じテンプレートなら使い回す）
+# =====================
+LAYOUT_PEEK_ROWS = 10            # レイアウト判定に使う先頭の行数（値のある行）
+LAYOUT_CACHE_MAX_ENTRIES = 256
+
+_layout_cache = OrderedDict()
+_layout_cache_lock = threading.Lock()
+
+def _is_label(v) -> bool:
+    """日付として読めない文字列セル（見出し）か。"""
+    return isinstance(v, str) and pd.isna(_decode_date_uniques(pd.Series([v], dtype=object), "auto")[0])
+
+def _layout_fingerprint(types: list, head: list, ncols: int) -> tuple:
+    """先頭行の見出しセル（日付として読めない文字列）・その行番号・列数から作るテンプレートの指紋。
+    数値や日付は日々変わるので含めない。"""
+    labels = [(r, sorted((c, v) for c, v in values.items() if _is_label(v))) for r, values in head]
+    return (tuple(types), ncols, hashlib.sha1(repr(labels).encode()).hexdigest())
+
+def _detect_layout(types: list, head: list) -> dict:
+    """先頭行から {"header_row": 見出しの最終行(1始まり)} を決める。
+    見出しは1行目と、それに続けて日付列に見出しの文字列がある行で、指紋に含まれるセルだけから決まる。
+    それより後の行はすべて読み、日付として読めない行は日付の変換（NaT）で落とす。"""
+    date_cols = {i for t in types for i in COST_SHEET_SPEC[t]["date"]}
+    header_row = 1
+    for r, values in head:
+        if r == header_row + 1 and any(_is_label(values.get(i)) for i in date_cols): header_row = r
+        elif r > 1: break
+    return {"header_row": header_row}
+
+def resolve_sheet_layout(types: list, head: list, ncols: int) -> dict:
+    """head=[(行番号, {列番号: 値}), ...]（先頭 LAYOUT_PEEK_ROWS 行）からシートのレイアウトを返す。
+    指紋が同じシート（同じテンプレートの次回以降のアップロード）は判定せずキャッシュから返す。"""
+    key = _layout_fingerprint(types, head, ncols)
+    with _layout_cache_lock:
+        layout = _layout_cache.get(key)
+        if layout is not None:
+            _layout_cache.move_to_end(key)
+            return layout
+    layout = _detect_layout(types, head)
+    with _layout_cache_lock:
+        _layout_cache[key] = layout
+        while len(_layout_cache) > LAYOUT_CACHE_MAX_ENTRIES: _layout_cache.popitem(last=False)
+    return layout
+
+# =====================
+# コストレポート読み込み（各シート1回のみ、列定義の列だけを解析）
+# =====================
+def _read_cost_sheet_streaming(zf: zipfile.ZipFile, book: dict, path: str, types: list) -> pd.DataFrame:
+    date_cols = sorted({i for t in types for i in COST_SHEET_SPEC[t]["date"]})
+    value_cols = sorted({i for t in types for i in COST_SHEET_SPEC[t]["values"]} - set(date_cols))
+    dates = {i: [] for i in date_cols}
+    nums = {i: array("d") for i in value_cols}
+    stats = {"ncols": 0}
+    rows = _xlsx_iter_rows(zf, book, path, cols=set(date_cols) | set(value_cols), stats=stats)
+    # 先頭行でレイアウトを決めてから、同じ走査の続きで本体を読む（シートの解析は1回）
+    head = list(islice(rows, LAYOUT_PEEK_ROWS))
+    layout = resolve_sheet_layout(types, head, stats["ncols"])
+    for rownum, values in chain(head, rows):
+        if rownum <= layout["header_row"]: continue  # 見出し行
+        for i in date_cols: dates[i].append(values.get(i))
+        for i in value_cols: nums[i].append(_xlsx_float(values.get(i)))
+    data = {}
+    for i in sorted(date_cols + value_cols):
+        if i >= stats["ncols"]: continue
+        if i in dates:
+            data[i] = coerce_date_series(pd.Series(dates[i], dtype=object))
+        else:
+            data[i] = np.frombuffer(nums[i], dtype=np.float64)
+    return pd.DataFrame(data)
+
+def _read_cost_sheet_openpyxl(xls: pd.ExcelFile, sheet_name: str, types: list):
+    """ストリーミングで読めないブック用。見出しなしで1回だけ読み、レイアウトに従って見出し行を落とす。"""
+    try: df = pd.read_excel(xls, sheet_name=sheet_name, engine="openpyxl", header=None)
+    except Exception: return None
+    df.columns = range(len(df.columns))
+    spec_cols = {i for t in types for i in COST_SHEET_SPEC[t]["date"] + COST_SHEET_SPEC[t]["values"]}
+    head = []
+    for r, row in enumerate(df.head(LAYOUT_PEEK_ROWS).to_dict("records"), start=1):
+        values = {c: v for c, v in row.items() if c in spec_cols and pd.notna(v)}
+        if values: head.append((r, values))
+    layout = resolve_sheet_layout(types, head, len(df.columns))
+    df = df.iloc[layout["header_row"]:].reset_index(drop=True).infer_objects()
+    for i in {i for t in types for i in COST_SHEET_SPEC[t]["date"]}:
+        if i in df.columns: df[i] = coerce_date_series(df[i])
+    return df
+
+def _read_cost_sheet_at(xlsx_path: str, book: dict, path: str, types: list) -> pd.DataFrame:
+    # プロセスプールのワーカーで1シートを解析する（ブック情報は親で読んだものを使う）
+    with zipfile.ZipFile(xlsx_path) as zf:
+        return _read_cost_sheet_streaming(zf, book, path, types)
+
+def _load_cost_sheets_parallel(data: bytes, book: dict, targets: list, executor: Executor) -> dict:
+    # ワーカーにはブックの一時ファイルのパスを渡し、結果はブックのシート順で組み立てる
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        futures = [
+            (name, executor.submit(_read_cost_sheet_at, tmp_path, book, path, types))
+            for name, path, types in targets
+        ]
+        return {name: fut.result() for name, fut in futures}
+    finally:
+        os.unlink(tmp_path)
+
+def load_cost_sheets(file, executor: Executor = None) -> dict:
+    """コストレポートの対象シート（Listing/Affiliate/Display）を一度だけ読み込む。
+    戻り値は {シート名: DataFrame}（ブックのシート順）。列名は元シートの列番号（0始まり）で、
+    COST_SHEET_SPEC の列のうちシート内に存在するものだけを持つ（日付列は読み込み時に datetime64 へ変換済み）。
+    集計・日別・目標・Excel出力はすべてこれを参照する。
+    executor（プロセスプール）を渡すと、対象シートが複数あればシート単位で並列に解析する。"""
+    try:
+        with zipfile.ZipFile(file) as zf:
+            book = _xlsx_open(zf)
+            targets = [(name, path, cost_sheet_types(name)) for name, path in book["sheets"] if cost_sheet_types(name)]
+            if executor is None or len(targets) < 2:
+                return {name: _read_cost_sheet_streaming(zf, book, path, types) for name, path, types in targets}
+        file.seek(0)
+        try:
+            return _load_cost_sheets_parallel(file.read(), book, targets, executor)
+        except BrokenProcessPool:
+            file.seek(0)
+            return load_cost_sheets(file)
+    except (zipfile.BadZipFile, KeyError, IndexError, ValueError, ET.ParseError):
+        file.seek(0)
+    # ストリーミングで読めないブックは全列を読み、列番号で参照できるようにする
+    xls = pd.ExcelFile(file, engine="openpyxl")
+    sheets = {}
+    for s in xls.sheet_names:
+        if not cost_sheet_types(s): continue
+        df = _read_cost_sheet_openpyxl(xls, s, cost_sheet_types(s))
+        if df is not None: sheets[s] = df
+    return sheets
+
+# =====================
+# AFマスタ（コンパイル済み索引）
+# =====================
+# 索引の形が変わったら上げる（保存済みの索引を無効化する）
+AF_MASTER_INDEX_VERSION = "2"
+
+def read_af_master(file) -> pd.DataFrame:
+    """AFマスター.xlsx の B:D（AFコード/媒体/分類）を読み、Display 行を除く。"""
+    af_df = pd.read_excel(file, usecols="B:D", header=1, engine="openpyxl")
+    af_df.columns = ["AFコード", "媒体", "分類"]
+    return af_df[~af_df["分類"].astype(str).str.contains("display", case=False, na=False)]
+
+def compile_af_master(af_df: pd.DataFrame) -> pd.DataFrame:
+    """AFマスタ表を検索用の索引（index=AFコード、列=媒体/分類）にする。
+    重複コードは後勝ち、媒体は改行除去・別名変換（MEDIA_ALIAS）済み。"""
+    master = af_df.drop_duplicates("AFコード", keep="last").set_index("AFコード")[["媒体", "分類"]]
+    media = master["媒体"].astype(str).str.replace("\r", "", regex=False).str.replace("\n", "", regex=False).str.strip()
+    return master.assign(媒体=media.replace(MEDIA_ALIAS))
+
+def _af_master_cache_dir() -> str:
+    # アプリ専用のキャッシュディレクトリ（XDG_CACHE_HOME または ~/.cache 配下）
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cv_cost", "af_master_index")
+
+def _owned_private_dir(path: str) -> bool:
+    """path を本人だけが書き込めるディレクトリとして用意できたか（他人の書き込めるディレクトリは使わない）。"""
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.stat(path)
+    except OSError:
+        return False
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022): return False
+    return True
+
+def load_af_master_index(path: str, cache_dir: str = None) -> tuple:
+    """AFマスタの索引と、その内容キー（ソースの sha256 ＋索引バージョン）を返す。
+    索引はソースのハッシュごとに Parquet で保存し、内容が同じなら xlsx を解析せずに読み込む
+    （実行可能な形式の pickle は使わない。保存先は本人だけが書き込めるディレクトリに限る）。"""
+    with open(path, "rb") as f:
+        data = f.read()
+    key = f"{AF_MASTER_INDEX_VERSION}-{hashlib.sha256(data).hexdigest()}"
+    cache_dir = cache_dir or _af_master_cache_dir()
+    use_cache = _owned_private_dir(cache_dir)
+    index_path = os.path.join(cache_dir, f"{key}.parquet")
+    if use_cache:
+        try:
+            return pd.read_parquet(index_path), key
+        except Exception:
+            pass  # 未作成・破損・pyarrow が無い場合は作り直す
+    master = compile_af_master(read_af_master(BytesIO(data)))
+    if use_cache:
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            master.to_parquet(tmp_path)
+            os.replace(tmp_path, index_path)
+        except (OSError, ValueError, TypeError, ImportError):
+            # 保存できなくても（AFコードの型が混在して Parquet にできない場合も）索引自体は使える
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+    return master, key
+
+# =====================
+# コード分類（CVデータの列名 → 媒体／分類）
+# =====================
+AFF_KEYS = ("GEN", "AFA", "AFP", "RAA")
+
+def classify_codes(codes, af_master: pd.DataFrame) -> pd.DataFrame:
+    """CVデータのコード列名を一括で正規化・分類する。
+    戻り値は集計対象のコードのみ（index=元の列名、列=コード_norm/媒体/分類、媒体は別名変換済み）。
+    AFF_KEYS を含むものは Affiliate、それ以外は AFマスタ索引（compile_af_master）で引き、未登録は除外する。"""
+    labels = pd.Index(codes)
+    norm = pd.Series(labels.astype(str), index=labels)
+    norm = norm.str.replace("\r", "", regex=False).str.replace("\n", "", regex=False).str.strip().str.upper()
+    is_aff = norm.str.contains("|".join(AFF_KEYS), regex=True).to_numpy()
+
+    hit = af_master.reindex(norm.to_numpy())
+    in_master = norm.isin(af_master.index).to_numpy()
+
+    out = pd.DataFrame({
+        "コード_norm": norm.to_numpy(),
+        "媒体": np.where(is_aff, "Affiliate", hit["媒体"].to_numpy(dtype=object)),
+        "分類": np.where(is_aff, "Affiliate", hit["分類"].to_numpy(dtype=object)),
+    }, index=labels)
+    return out[is_aff | in_master].copy()
+
+# =====================
+# CVデータ読み込み
+# =====================
+def _parse_cv_streaming(file, af_master: pd.DataFrame) -> pd.DataFrame:
+    """先頭シートをストリーミングで読み、A列（日付）と集計対象のコード列だけを取り出す。
+    コード列は float64（空欄・非数値は NaN）。"""
+    with zipfile.ZipFile(file) as zf:
+        book = _xlsx_open(zf)
+        _, path = book["sheets"][0]
+        header = {}
+        for rownum, values in _xlsx_iter_rows(zf, book, path):
+            if rownum == 1: header = values
+            break
+        if not header: raise ValueError("CVデータのヘッダー行がありません")
+        labels = _header_labels(header, max(header) + 1)
+        codes = classify_codes(labels[1:], af_master)
+        keep = [i for i in range(1, len(labels)) if labels[i] in codes.index]
+        raw_dates = []
+        arrays = {i: array("d") for i in keep}
+        for rownum, values in _xlsx_iter_rows(zf, book, path, cols=set([0] + keep)):
+            if rownum == 1: continue  # ヘッダー行
+            raw_dates.append(values.get(0))
+            for i in keep: arrays[i].append(_xlsx_float(values.get(i)))
+    data = {labels[0]: pd.Series(raw_dates, dtype=object)}
+    for i in keep:
+        data[labels[i]] = np.frombuffer(arrays[i], dtype=np.float64)
+    df = pd.DataFrame(data)
+    df["日付"] = coerce_date_series(df.iloc[:, 0], "yyyymmdd")
+    return df
+
+def parse_cv(file, af_master: pd.DataFrame) -> pd.DataFrame:
+    try:
+        return _parse_cv_streaming(file, af_master)
+    except (zipfile.BadZipFile, KeyError, IndexError, ValueError, ET.ParseError):
+        file.seek(0)
+    # ストリーミングで読めないブックは従来どおり全体を読む
+    df = pd.read_excel(file, header=0, engine="openpyxl")
+    df["日付"] = coerce_date_series(df.iloc[:, 0], "yyyymmdd")
+    return df
+
+# =====================
+# 日別キューブ（期間に依存しない事前集計）
+# =====================
+class DailyCube:
+    """日付×列（(分類, 媒体) やコスト区分）の日別合計。累積和を保持し、
+    任意期間の合計を二分探索＋差分で返す（期間変更時にファイル全体を再走査しない）。
+    日別の値そのものも持つ（累積和の差分は先頭日によって丸め誤差が変わるため、履歴ストアには元の値を渡す）。"""
+    def __init__(self, frame: pd.DataFrame):
+        frame = frame.sort_index()
+        self.columns = frame.columns
+        self.dates = frame.index.values.astype("datetime64[ns]")
+        self.values = frame.to_numpy(dtype=float)
+        self.cum = np.zeros((len(frame) + 1, len(frame.columns)))
+        np.cumsum(self.values, axis=0, out=self.cum[1:])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.cum.nbytes + self.values.nbytes + self.dates.nbytes)
+
+    def daily(self) -> pd.DataFrame:
+        """日別の値を 日付×列 の表で返す。"""
+        return pd.DataFrame(self.values, index=pd.DatetimeIndex(self.dates), columns=self.columns)
+
+    def period_sum(self, start, end) -> pd.Series:
+        i = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start), "ns"), side="left")
+        j = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end), "ns"), side="right")
+        return pd.Series(self.cum[j] - self.cum[i], index=self.columns)
+
+    def period_sums(self, starts, ends) -> np.ndarray:
+        """複数期間の合計を 期間×列 の配列で返す（全期間の境界を1回の二分探索で引く）。"""
+        i = np.searchsorted(self.dates, pd.to_datetime(list(starts)).values.astype("datetime64[ns]"), side="left")
+        j = np.searchsorted(self.dates, pd.to_datetime(list(ends)).values.astype("datetime64[ns]"), side="right")
+        return self.cum[j] - self.cum[i]
+
+# =====================
+# CV集計（期間に依存しない部分）
+# =====================
+def build_cv_cube(df: pd.DataFrame, codes: pd.DataFrame) -> DailyCube:
+    """CVデータを日付×(分類, 媒体)の日別合計に畳み込む（アップロードごとに1回）。"""
+    keys = pd.MultiIndex.from_frame(codes[["分類", "媒体"]]).sort_values().unique()
+    group_ids = keys.get_indexer(pd.MultiIndex.from_frame(codes[["分類", "媒体"]]))
+    valid = df[df["日付"].notna()]
+    values = valid[codes.index].apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy(dtype=float)
+    onehot = np.zeros((len(codes), len(keys)))
+    onehot[np.arange(len(codes)), group_ids] = 1.0
+    daily = pd.DataFrame(values @ onehot, index=valid["日付"].values, columns=keys)
+    return DailyCube(daily.groupby(level=0).sum())
+
+def daily_cv_by_media(filtered: pd.DataFrame, codes: pd.DataFrame) -> pd.DataFrame:
+    """期間内のCVを (日付, 割り振り) ごとに合計する。正のCVのみを対象とし、
+    正のCVが1件もない (日付, 割り振り) は出力しない。領域は媒体内で最初のコードの分類。"""
+    columns = ["日付", "割り振り", "領域", "合計値"]
+    valid = filtered[filtered["日付"].notna()]
+    if len(codes) == 0 or len(valid) == 0:
+        return pd.DataFrame(columns=columns)
+
+    media_ids, media = pd.factorize(codes["媒体"])
+    onehot = np.zeros((len(codes), len(media)))
+    onehot[np.arange(len(codes)), media_ids] = 1.0
+
+    values = valid[codes.index].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    positive = values > 0
+    sums = np.where(positive, values, 0.0) @ onehot
+    hits = positive.astype(float) @ onehot
+
+    dates = pd.DatetimeIndex(valid["日付"]).floor("D")
+    sums = pd.DataFrame(sums, index=dates, columns=media).groupby(level=0).sum()
+    hits = pd.DataFrame(hits, index=dates, columns=media).groupby(level=0).sum()
+
+    long = sums.stack()
+    long = long[hits.stack().to_numpy() > 0]
+    if long.empty:
+        return pd.DataFrame(columns=columns)
+    category = codes.groupby("媒体", sort=False)["分類"].first()
+    out = pd.DataFrame({
+        "日付": long.index.get_level_values(0),
+        "割り振り": long.index.get_level_values(1),
+        "合計値": long.to_numpy(),
+    })
+    out["領域"] = out["割り振り"].map(category)
+    out = out[columns].sort_values(["日付", "割り振り"]).reset_index(drop=True)
+    # 媒体・領域はカテゴリ、CV件数は float32 で持つ（件数なので精度は足りる）
+    return out.astype({"割り振り": "category", "領域": "category", "合計値": "float32"})
+
+# =====================
+# コスト集計（期間に依存しない部分）
+# =====================
+# コストレポート日別（Forecast/実績）の値列の並び
+DAILY_COST_REPORT_COLUMNS = [
+    "Forecast_AFCV_Listing", "Forecast_AFCV_Display", "Forecast_AFCV_Affiliate",
+    "Forecast_配信費_Listing", "Forecast_配信費_Display", "Forecast_配信費_Affiliate",
+    "実績_AFCV_Listing", "実績_AFCV_Display", "実績_AFCV_Affiliate",
+    "実績_配信費_Listing", "実績_配信費_Display", "実績_配信費_Affiliate",
+]
+
+COST_SUMMARY_KEYS = (
+    "Affiliate_total", "Listing_total",
+    "LS_Google単体", "LS_Google単体以外", "LS_Googleその他",
+    "LS_Yahoo単体", "LS_Yahoo単体以外",
+    "LS_MS単体", "LS_MS単体以外",
+    "LS_Google単体→2025年11月よりMSその他",
+    "LS_Yahoo単体（PSD）",
+)
+
+def build_cost_cube(cost_sheets: dict) -> DailyCube:
+    """Listing/Affiliateシートの費用区分を日付×区分の日別合計に畳み込む（アップロードごとに1回）。"""
+    parts = []
+    for sheet, df in cost_sheets.items():
+        sl = sheet.lower()
+        if not (("listing" in sl) or ("affiliate" in sl)): continue
+        sheet_type = "Listing" if "listing" in sl else "Affiliate"
+        date_col_index = DAILY_COST_COLS[sheet_type]["date"]
+        if date_col_index not in df.columns: continue
+        cols = LISTING_COST_COLS if sheet_type == "Listing" else AFFILIATE_COST_COLS
+        s_date = coerce_date_series(df[date_col_index]).dt.floor("D")
+        part = pd.DataFrame({
+            k: pd.to_numeric(df[idx], errors="coerce").fillna(0).values
+            for k, idx in cols.items() if idx in df.columns
+        }, index=s_date.values)
+        parts.append(part[part.index.notna()])
+    keys = list(COST_SUMMARY_KEYS)
+    if not parts:
+        return DailyCube(pd.DataFrame(columns=keys, index=pd.DatetimeIndex([])))
+    daily = pd.concat(parts).groupby(level=0).sum()
+    return DailyCube(daily.reindex(columns=keys, fill_value=0.0))
+
+# コストレポートから日別 Forecast/実績（全期間）
+def build_daily_cost_report_all_range(cost_sheets: dict):
+    """日付（datetime64）と DAILY_COST_REPORT_COLUMNS の表。対象シートや日付がなければ None。
+    日付の書式（yyyy/mm/dd）は表示・出力時に当てる。"""
+    sheets = []
+    for s in cost_sheets:
+        sl = s.lower()
+        if "affiliate" in sl: sheets.append((s, "Affiliate"))
+        elif "listing" in sl: sheets.append((s, "Listing"))
+        elif "display" in sl and "nonifrs" not in sl: sheets.append((s, "Display"))
+    if not sheets: return None
+
+    col_idx = DAILY_COST_COLS
+
+    all_dates_collect = []
+    for sheet_name, typ in sheets:
+        df0 = cost_sheets[sheet_name]
+        if df0 is None or df0.empty: continue
+        idxs = col_idx[typ]
+        if idxs["date"] not in df0.columns: continue
+        s_date0 = coerce_date_series(df0[idxs["date"]]).dropna()
+        if not s_date0.empty:
+            all_dates_collect.extend(list(pd.to_datetime(s_date0).dt.floor("D")))
+    if not all_dates_collect: return None
+
+    global_min = min(all_dates_collect); global_max = max(all_dates_collect)
+    all_days = pd.date_range(global_min, global_max, freq="D")
+    def zero_series(): return pd.Series(0.0, index=all_days)
+
+    series_map = {
+        ("Forecast", "AFCV", "Listing"): zero_series(),
+        ("Forecast", "AFCV", "Display"): zero_series(),
+        ("Forecast", "AFCV", "Affiliate"): zero_series(),
+        ("Forecast", "配信費", "Listing"): zero_series(),
+        ("Forecast", "配信費", "Display"): zero_series(),
+        ("Forecast", "配信費", "Affiliate"): zero_series(),
+        ("実績", "AFCV", "Listing"): zero_series(),
+        ("実績", "AFCV", "Display"): zero_series(),
+        ("実績", "AFCV", "Affiliate"): zero_series(),
+        ("実績", "配信費", "Listing"): zero_series(),
+        ("実績", "配信費", "Display"): zero_series(),
+        ("実績", "配信費", "Affiliate"): zero_series(),
+    }
+
+    for sheet_name, typ in sheets:
+        df = cost_sheets[sheet_name]
+        if df is None or df.empty: continue
+        idxs = col_idx[typ]
+        if idxs["date"] not in df.columns: continue
+        s_date = coerce_date_series(df[idxs["date"]])
+        if s_date.dropna().empty: continue
+        def safe_num(col_i):
+            if col_i in df.columns:
+                return pd.to_numeric(df[col_i], errors="coerce").fillna(0.0)
+            return pd.Series(0.0, index=df.index)
+        s_fc_afcv = safe_num(idxs["fc_afcv"])
+        s_fc_cost = safe_num(idxs["fc_cost"])
+        s_ac_afcv = safe_num(idxs["actual_afcv"])
+        s_ac_cost = safe_num(idxs["actual_cost"])
+        if typ == "Affiliate":
+            s_ac_afcv = s_ac_afcv * 0.9
+
+        g = pd.DataFrame({
+            "_date": pd.to_datetime(s_date).dt.floor("D"),
+            "_fc_afcv": s_fc_afcv.values, "_fc_cost": s_fc_cost.values,
+            "_ac_afcv": s_ac_afcv.values, "_ac_cost": s_ac_cost.values,
+        })
+        g = g.dropna(subset=["_date"]).groupby("_date", as_index=True).sum()
+        g = g.reindex(all_days, fill_value=0.0)
+
+        series_map[("Forecast", "AFCV", typ)] += g["_fc_afcv"]
+        series_map[("Forecast", "配信費", typ)] += g["_fc_cost"]
+        series_map[("実績", "AFCV", typ)] += g["_ac_afcv"]
+        series_map[("実績", "配信費", typ)] += g["_ac_cost"]
+
+    order = [
+        ("Forecast", "AFCV", "Listing"), ("Forecast", "AFCV", "Display"), ("Forecast", "AFCV", "Affiliate"),
+        ("Forecast", "配信費", "Listing"), ("Forecast", "配信費", "Display"), ("Forecast", "配信費", "Affiliate"),
+        ("実績", "AFCV", "Listing"), ("実績", "AFCV", "Display"), ("実績", "AFCV", "Affiliate"),
+        ("実績", "配信費", "Listing"), ("実績", "配信費", "Display"), ("実績", "配信費", "Affiliate"),
+    ]
+    data_dict = {f"{k[0]}_{k[1]}_{k[2]}": series_map[k].astype(float) for k in order}
+    df_flat = pd.DataFrame(data_dict, index=series_map[("Forecast","AFCV","Listing")].index).reset_index()
+    df_flat.rename(columns={"index": "日付"}, inplace=True)
+    return df_flat
+
+# 目標（コストから日付一致で取得）
+def build_daily_targets_from_cost(cost_sheets: dict) -> pd.Series:
+    """Listing / Display（nonIFRS 除く）シートの目標列を (日付, 割り振り) 索引の Series「目標」にする。
+    シートごとに目標列をまとめて数値化し、縦持ちにしてから全シート分を合計する（索引は昇順）。"""
+    listing_idx_map = {excel_col_to_idx(v): k for k, v in LISTING_TARGET_COLS.items()}
+    display_idx_map = {excel_col_to_idx(v): k for k, v in DISPLAY_TARGET_COLS.items()}
+
+    parts = []
+    for s in cost_sheets:
+        sl = s.lower()
+        if "listing" in sl:
+            idx_map = listing_idx_map
+        elif "display" in sl and "nonifrs" not in sl:
+            idx_map = display_idx_map
+        else:
+            continue
+        df = cost_sheets[s]
+        if df is None or df.empty: continue
+
+        date_col = 1  # B列
+        if date_col not in df.columns: continue
+        cols = [c for c in idx_map if c in df.columns]
+        if not cols: continue
+        dates = pd.DatetimeIndex(coerce_date_series(df[date_col]))
+        valid = ~dates.isna()
+        if not valid.any(): continue
+        wide = df.loc[valid, cols].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+        wide.index = dates[valid].floor("D").rename("日付")
+        wide.columns = pd.Index([idx_map[c] for c in cols], name="割り振り")
+        parts.append(wide.groupby(level=0).sum().stack())
+
+    if not parts:
+        return pd.Series(dtype=float, name="目標", index=pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex([]), pd.Index([], dtype=object)], names=["日付", "割り振り"]))
+    return pd.concat(parts).astype(float).groupby(level=["日付", "割り振り"]).sum().rename("目標")
+
+# =====================
+# 推移グラフ用の粒度別集計（日・週・月。期間に依存しないのでアップロードごとに1回）
+# =====================
+# 粒度名 → resample の規則（週は月曜始まり、月は1日始まりのラベル）
+TREND_TIERS = {"日": None, "週": "W-MON", "月": "MS"}
+# 1系列あたりの描画点数の上限（超えない最も細かい粒度を選ぶ）
+TREND_MAX_POINTS = 400
+
+def build_trend_tiers(daily: pd.DataFrame) -> dict:
+    """日付索引の日別表を粒度ごとの合計表 {"日": ..., "週": ..., "月": ...} にする。"""
+    daily = daily.sort_index().astype(float)
+    tiers = {}
+    for name, rule in TREND_TIERS.items():
+        tiers[name] = daily if rule is None else daily.resample(rule, label="left", closed="left").sum()
+    return tiers
+
+def cost_trend_tiers(daily_cost: pd.DataFrame) -> dict:
+    """コストレポート日別（Forecast/実績 × AFCV/配信費 × Listing/Display/Affiliate）の粒度別集計。"""
+    if daily_cost is None or daily_cost.empty: return None
+    return build_trend_tiers(daily_cost.set_index("日付")[DAILY_COST_REPORT_COLUMNS])
+
+def cv_trend_tiers(cv_cube: DailyCube) -> dict:
+    """媒体ごとのCV（キューブの日別値を媒体で合計）の粒度別集計。"""
+    if cv_cube is None or len(cv_cube.dates) == 0: return None
+    daily = cv_cube.daily()
+    if isinstance(daily.columns, pd.MultiIndex):
+        daily = daily.T.groupby(level="媒体").sum().T
+    return build_trend_tiers(daily)
+
+def target_trend_tiers(daily_targets: pd.Series) -> dict:
+    """媒体ごとの目標の粒度別集計。"""
+    if daily_targets is None or daily_targets.empty: return None
+    return build_trend_tiers(daily_targets.unstack("割り振り", fill_value=0.0))
+
+def _trend_overlap(frame: pd.DataFrame, tier: str, start_date, end_date) -> np.ndarray:
+    """粒度 tier の区切り（週・月は先頭日が索引）のうち [start_date, end_date] と重なる行の真偽値。"""
+    step = pd.tseries.frequencies.to_offset(TREND_TIERS[tier] or "D")
+    return ((frame.index + step > pd.Timestamp(start_date)) & (frame.index <= pd.Timestamp(end_date)))
+
+def pick_trend_tier(tiers: dict, start_date, end_date, max_points: int = TREND_MAX_POINTS) -> str:
+    """表示範囲の点数が max_points 以下になる最も細かい粒度名。"""
+    for name, frame in tiers.items():
+        if _trend_overlap(frame, name, start_date, end_date).sum() <= max_points: return name
+    return list(tiers)[-1]
+
+def trend_slice(tiers: dict, tier: str, start_date, end_date) -> pd.DataFrame:
+    """粒度 tier の表から表示範囲と重なる行を取り出す（範囲の端にかかる週・月も含める）。"""
+    frame = tiers[tier]
+    return frame.loc[_trend_overlap(frame, tier, start_date, end_date)]
+
+# =====================
+# 期間集計（領域別コンディション用テーブル）
+# =====================
+def period_days(start_date, end_date) -> int:
+    return (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
+
+def filter_period(cv_df: pd.DataFrame, start_date, end_date) -> pd.DataFrame:
+    """期間内の行だけを返す（キャッシュ共有のため元の cv_df は書き換えない）。"""
+    return cv_df[
+        (cv_df["日付"] >= pd.to_datetime(start_date)) &
+        (cv_df["日付"] <= pd.to_datetime(end_date))
+    ]
+
+def cv_date_range(cv_df):
+    """CVデータの最小・最大日付（date）。読めなければ None。"""
+    try:
+        dt = cv_df["日付"].dropna()
+        if len(dt) > 0:
+            return dt.min().date(), dt.max().date()
+    except Exception:
+        pass
+    return None
+
+def cv_totals_for_period(cv_cube: DailyCube, start_date, end_date):
+    """(分類, 媒体) ごとの期間CV合計と日割り。対象コードがなければ None。"""
+    if len(cv_cube.columns) == 0: return None
+    out = cv_cube.period_sum(start_date, end_date).rename("CV合計").reset_index()
+    out["CV日割り"] = (out["CV合計"] / period_days(start_date, end_date)).round(2)
+    return out
+
+def cost_summaries_for_periods(cost_cube: DailyCube, periods: list) -> pd.DataFrame:
+    """費用区分 × 期間 の合計表（列は periods の順。Yahoo単体（PSD）は Yahoo単体へ合算）。"""
+    keys = list(COST_SUMMARY_KEYS)
+    if cost_cube is not None:
+        keys += [k for k in cost_cube.columns if k not in COST_SUMMARY_KEYS]
+    out = pd.DataFrame(0.0, index=keys, columns=range(len(periods)))
+    if cost_cube is None or len(periods) == 0: return out
+    starts, ends = zip(*periods)
+    out.loc[list(cost_cube.columns)] += cost_cube.period_sums(starts, ends).T
+    out.loc["LS_Yahoo単体"] += out.loc["LS_Yahoo単体（PSD）"]
+    out.loc["LS_Yahoo単体（PSD）"] = 0.0
+    return out
+
+def cost_summary_for_period(cost_cube: DailyCube, start_date, end_date) -> dict:
+    """期間内の費用区分ごとの合計（Yahoo単体（PSD）は Yahoo単体へ合算）。"""
+    return {k: float(v) for k, v in cost_summaries_for_periods(cost_cube, [(start_date, end_date)])[0].items()}
+
+# 集計行（ALL/SEM/Google/…）の定義。行名 → CVの分類・媒体（None は分類内すべて）と費用区分キー。
+# CV側と費用側で媒体の範囲が異なる行がある（Yahoo は媒体空欄のCVを含む、MSその他はCVだけ Microsoft とその他の両方に入る）
+SUMMARY_ROLLUPS = {
+    "ALL": {"categories": ("Affiliate", "Listing"), "media": None, "cost": ("Affiliate_total", "Listing_total")},
+    "SEM": {"categories": ("Listing",), "media": None, "cost": ("Listing_total",)},
+    "Google": {"categories": ("Listing",), "media": ("LS_Googleその他", "LS_Google単体", "LS_Google単体以外"),
+               "cost": ("LS_Googleその他", "LS_Google単体", "LS_Google単体以外")},
+    "Yahoo": {"categories": ("Listing",), "media": ("", "LS_Yahoo単体", "LS_Yahoo単体以外"),
+              "cost": ("LS_Yahoo単体", "LS_Yahoo単体以外")},
+    "Microsoft": {"categories": ("Listing",), "media": ("LS_MS単体", "LS_MS単体以外", "LS_Google単体→2025年11月よりMSその他"),
+                  "cost": ("LS_MS単体", "LS_MS単体以外")},
+    "単体": {"categories": ("Listing",), "media": ("LS_Google単体", "LS_Yahoo単体", "LS_MS単体"),
+             "cost": ("LS_Google単体", "LS_Yahoo単体", "LS_MS単体")},
+    "ブランド": {"categories": ("Listing",), "media": ("LS_Google単体以外", "LS_Yahoo単体以外", "LS_MS単体以外"),
+                 "cost": ("LS_Google単体以外", "LS_Yahoo単体以外", "LS_MS単体以外")},
+    "その他": {"categories": ("Listing",), "media": ("LS_Google単体→2025年11月よりMSその他", "LS_Googleその他"),
+               "cost": ("LS_Googleその他",)},
+}
+
+def _rollup_membership(keys, kind: str) -> np.ndarray:
+    """集計行 × keys の 0/1 行列。kind="cv" なら keys は (分類, 媒体) の組、"cost" なら費用区分キー。"""
+    m = np.zeros((len(SUMMARY_ROLLUPS), len(keys)))
+    for i, spec in enumerate(SUMMARY_ROLLUPS.values()):
+        for j, key in enumerate(keys):
+            if kind == "cv":
+                m[i, j] = key[0] in spec["categories"] and (spec["media"] is None or key[1] in spec["media"])
+            else:
+                m[i, j] = key in spec["cost"]
+    return m
+
+def rollup(values, kind: str):
+    """CV（kind="cv"、(分類, 媒体) が索引）または費用（kind="cost"、費用区分が索引）を集計行ごとに合計する。
+    values は Series でも、期間ごとの列を持つ DataFrame でもよい（行列積1回で全集計行・全期間を出す）。"""
+    out = _rollup_membership(list(values.index), kind) @ values.to_numpy(dtype=float)
+    if values.ndim == 1: return pd.Series(out, index=list(SUMMARY_ROLLUPS))
+    return pd.DataFrame(out, index=list(SUMMARY_ROLLUPS), columns=values.columns)
+
+def cv_by_group(df) -> pd.Series:
+    """媒体別の行の CV合計 を (分類, 媒体) ごとに合計する（媒体の空欄は "" に揃える）。"""
+    if df is None or len(df) == 0: return pd.Series(dtype=float)
+    cv = pd.to_numeric(df["CV合計"], errors="coerce").fillna(0)
+    return cv.groupby([df["分類"].astype(str), df["媒体"].fillna("").astype(str)]).sum()
+
+def make_summary_rows(df, cost_summary: dict, days: int, with_cost: bool):
+    cv_totals = rollup(cv_by_group(df), "cv")
+    cost_totals = rollup(pd.Series(cost_summary, dtype=float), "cost")
+    return pd.DataFrame({
+        "分類": list(SUMMARY_ROLLUPS), "媒体": "",
+        "CV合計": [round(float(v), 0) for v in cv_totals],
+        "CV日割り": [round(float(v) / days, 2) for v in cv_totals],
+        "合計費用": [round(float(v), 0) if with_cost else "" for v in cost_totals],
+    })
+
+# 媒体別の行の媒体名 → 合計費用に使う費用区分キー（ここに無い媒体の行は合計費用を空欄にする）
+MEDIA_COST_KEYS = {
+    "Affiliate": "Affiliate_total",
+    "LS_Googleその他": "LS_Googleその他",
+    "LS_Google単体": "LS_Google単体",
+    "LS_Google単体以外": "LS_Google単体以外",
+    "LS_MS単体": "LS_MS単体",
+    "LS_MS単体以外": "LS_MS単体以外",
+    "LS_Yahoo単体": "LS_Yahoo単体",
+    "LS_Yahoo単体以外": "LS_Yahoo単体以外",
+}
+
+def apply_cost_to_media_rows(base_df: pd.DataFrame, cost_summary: dict, with_cost: bool) -> pd.DataFrame:
+    if base_df is None or len(base_df) == 0 or not with_cost: return base_df
+    media_cost_map = {m: cost_summary.get(k, 0.0) for m, k in MEDIA_COST_KEYS.items()}
+    base_df = base_df.copy()
+    base_df["媒体_norm"] = base_df["媒体"].apply(norm_text).apply(alias_media)
+    def _pick_cost(media_norm: str):
+        if media_norm in media_cost_map: return round(float(media_cost_map[media_norm]), 0)
+        return ""
+    base_df["合計費用"] = base_df["媒体_norm"].apply(_pick_cost)
+    base_df.drop(columns=["媒体_norm"], inplace=True)
+    return base_df
+
+def build_condition_table(cv_result_base, cost_summary: dict, days: int, with_cost: bool):
+    """媒体別の行＋集計行（ALL/SEM/Google/…）。with_cost=False なら合計費用は空欄。"""
+    if cv_result_base is None or len(cv_result_base) == 0: return None
+    base = cv_result_base.copy()
+    base["媒体"] = base["媒体"].apply(alias_media)
+    base["合計費用"] = ""
+    base = apply_cost_to_media_rows(base, cost_summary, with_cost)
+    summary_rows = make_summary_rows(base, cost_summary, days, with_cost)
+    out = pd.concat([base, summary_rows], ignore_index=True)
+    return out.astype({"分類": "category", "媒体": "category"})
+
+# =====================
+# 期間比較（複数期間の領域別コンディション表を横に並べる）
+# =====================
+PERIOD_COMPARE_METRICS = ("CV合計", "CV日割り", "合計費用")
+
+def split_periods(start_date, end_date, unit: str) -> list:
+    """start_date～end_date を unit（"週"=月曜始まり / "月"）ごとに区切った [(開始日, 終了日), ...]。
+    先頭と末尾の区切りは範囲に合わせて切り詰める。"""
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    if start > end: return []
+    edges = pd.date_range(start, end, freq=TREND_TIERS[unit]).union([start])
+    ends = list(edges[1:] - pd.Timedelta(days=1)) + [end]
+    return [(s.date(), e.date()) for s, e in zip(edges, ends)]
+
+def period_label(start_date, end_date) -> str:
+    return f"{pd.Timestamp(start_date):%Y/%m/%d}～{pd.Timestamp(end_date):%Y/%m/%d}"
+
+def build_period_comparison(cv_cube: DailyCube, cost_cube: DailyCube, periods: list, with_cost: bool):
+    """periods=[(開始日, 終了日), ...] ごとの領域別コンディション表を横に並べる。
+    行は build_condition_table と同じ（媒体別の行＋集計行）、列は ("", 分類/媒体) と
+    (期間ラベル, CV合計/CV日割り/合計費用) の2段。全期間をキューブの累積和から一度に引き、
+    集計行は rollup の行列積1回で全期間分を出す。"""
+    periods = list(dict.fromkeys((pd.Timestamp(s).date(), pd.Timestamp(e).date()) for s, e in periods))
+    if cv_cube is None or len(cv_cube.columns) == 0 or not periods: return None
+    starts, ends = zip(*periods)
+    days = np.array([period_days(s, e) for s, e in periods], dtype=float)
+
+    keys = cv_cube.columns.to_frame(index=False)
+    media = keys["媒体"].apply(alias_media)
+    cv = cv_cube.period_sums(starts, ends).T                       # (分類, 媒体) × 期間
+    cost = cost_summaries_for_periods(cost_cube, periods)          # 費用区分 × 期間
+
+    # 媒体別の行：費用区分に対応する媒体だけ合計費用を入れる
+    media_cost = cost.reindex(media.apply(lambda m: MEDIA_COST_KEYS.get(alias_media(m)))).to_numpy()
+    has_cost = media.apply(lambda m: alias_media(m) in MEDIA_COST_KEYS).to_numpy() & with_cost
+
+    # 集計行：媒体の空欄を "" に揃えて (分類, 媒体) ごとに合計してから rollup
+    groups = pd.DataFrame(cv, index=pd.MultiIndex.from_arrays(
+        [keys["分類"].astype(str), media.fillna("").astype(str)], names=["分類", "媒体"]))
+    cv_roll = rollup(groups.groupby(level=["分類", "媒体"]).sum(), "cv").to_numpy()
+    cost_roll = rollup(cost, "cost").to_numpy()
+
+    blocks = {"": pd.DataFrame({
+        "分類": list(keys["分類"]) + list(SUMMARY_ROLLUPS),
+        "媒体": list(media) + [""] * len(SUMMARY_ROLLUPS),
+    })}
+    for p, (s, e) in enumerate(periods):
+        blocks[period_label(s, e)] = pd.DataFrame({
+            "CV合計": list(cv[:, p]) + [round(float(v), 0) for v in cv_roll[:, p]],
+            "CV日割り": list(np.round(cv[:, p] / days[p], 2)) + [round(float(v) / days[p], 2) for v in cv_roll[:, p]],
+            "合計費用": [round(float(v), 0) if ok else "" for v, ok in zip(media_cost[:, p], has_cost)]
+                        + [round(float(v), 0) if with_cost else "" for v in cost_roll[:, p]],
+        })
+    return pd.concat(blocks, axis=1)
+
+def write_comparison_workbook(path: str, table: pd.DataFrame):
+    """期間比較表を「期間比較」シート1枚に書き出す（1行目に期間、2行目に項目名）。"""
+    labels = list(dict.fromkeys(c[0] for c in table.columns if c[0]))
+    with pd.ExcelWriter(path, engine="xlsxwriter") as writer:
+        workbook = writer.book
+        fmt_header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        fmt_int = workbook.add_format({"num_format": "#,##0"})
+        fmt_f2 = workbook.add_format({"num_format": "#,##0.00"})
+        metric_formats = {"CV合計": fmt_int, "CV日割り": fmt_f2, "合計費用": fmt_int}
+
+        ws = workbook.add_worksheet("期間比較")
+        ws.set_column(0, 0, 12)
+        ws.set_column(1, 1, 28)
+        ws.set_column(2, 1 + len(labels) * len(PERIOD_COMPARE_METRICS), 12)
+        ws.merge_range(0, 0, 1, 0, "分類", fmt_header)
+        ws.merge_range(0, 1, 1, 1, "媒体", fmt_header)
+        blocks = [(0, [_excel_values(table[("", "分類")]), _excel_values(table[("", "媒体")])], None)]
+        for n, label in enumerate(labels):
+            c = 2 + n * len(PERIOD_COMPARE_METRICS)
+            ws.merge_range(0, c, 0, c + len(PERIOD_COMPARE_METRICS) - 1, label, fmt_header)
+            ws.write_row(1, c, list(PERIOD_COMPARE_METRICS), fmt_header)
+            for k, metric in enumerate(PERIOD_COMPARE_METRICS):
+                blocks.append((c + k, [_excel_values(table[(label, metric)])], metric_formats[metric]))
+        _write_blocks(ws, 2, blocks)
+
+# =====================
+# Excel出力ヘルパー（列単位で値を用意し、行順に一括書き込み）
+# =====================
+EXCEL_CONSTANT_MEMORY_ROWS = 20000   # 出力行数がこれ以上なら xlsxwriter を constant_memory で使う
+EXCEL_EPOCH = np.datetime64("1899-12-30", "ns")
+
+def _excel_dates(values) -> list:
+    """日付列を Excel シリアル値のリストへまとめて変換（NaT は None = 空セル）。"""
+    d = pd.to_datetime(pd.Series(values)).to_numpy(dtype="datetime64[ns]")
+    serial = (d - EXCEL_EPOCH) / np.timedelta64(1, "D")
+    return pd.Series(serial).astype(object).where(~np.isnat(d), None).tolist()
+
+def _excel_values(values) -> list:
+    """1列分を xlsxwriter に渡す Python 値のリストへ（NaN は None = 空セル）。"""
+    s = pd.Series(values)
+    return s.astype(object).where(s.notna(), None).tolist()
+
+def _write_blocks(ws, first_row: int, blocks: list):
+    """列ブロック [(先頭列, [列の値リスト...], 書式), ...] を1行ずつ write_row で書く。
+    行の昇順にしか書かないので constant_memory でもそのまま使える。"""
+    row_iters = [zip(*cols) for _, cols, _ in blocks]
+    for r, cells in enumerate(zip(*row_iters), start=first_row):
+        for (c, _, fmt), vals in zip(blocks, cells):
+            ws.write_row(r, c, vals, fmt)
+
+def daily_allocation_with_targets(daily_allocation_df: pd.DataFrame, daily_targets) -> pd.DataFrame:
+    """日別シートの表（日別CVに目標を付ける。日付は日単位の datetime64）。"""
+    df_day = daily_allocation_df.copy()
+    # 目標の突合（(日付, 割り振り) 索引で揃える。期間外の日付は日別側に無いので拾われない）
+    if daily_targets is not None and not daily_targets.empty:
+        keys = pd.MultiIndex.from_arrays([pd.DatetimeIndex(df_day["日付"]), df_day["割り振り"]])
+        df_day["目標"] = daily_targets.reindex(keys).to_numpy()
+    else:
+        df_day["目標"] = np.nan
+    df_day["日付"] = pd.to_datetime(df_day["日付"]).dt.floor("D")
+    return df_day
+
+def write_export_workbook(path: str, final_df, daily_allocation_df, daily_targets, daily_cost_df,
+                           start_date, end_date, days: int):
+    """申込件数=期間適用 / 日別=期間適用 / コストレポート日別=全期間 の3シートを path に書き出す。"""
+    n_rows = sum(len(d) for d in (final_df, daily_allocation_df, daily_cost_df) if d is not None)
+    constant_memory = n_rows >= EXCEL_CONSTANT_MEMORY_ROWS
+    engine_kwargs = {"options": {"constant_memory": constant_memory}}
+    with pd.ExcelWriter(path, engine="xlsxwriter", engine_kwargs=engine_kwargs) as writer:
+        workbook = writer.book
+        # pandas の to_excel と同じ見出し書式
+        fmt_header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+
+        # 1) 申込件数
+        if final_df is not None and len(final_df) > 0:
+            ws = workbook.add_worksheet("申込件数")
+            ws.write_row(0, 0, list(final_df.columns), fmt_header)
+            ws.write(0, 6, "集計期間"); ws.write(0, 7, f"{start_date} ～ {end_date}")
+            ws.write(1, 6, "集計日数"); ws.write(1, 7, days)
+            _write_blocks(ws, 1, [(0, [_excel_values(final_df[c]) for c in final_df.columns], None)])
+
+        # 2) 日別（yyyy/m/d で確実に出力）
+        if daily_allocation_df is not None and len(daily_allocation_df) > 0:
+            df_day = daily_allocation_with_targets(daily_allocation_df, daily_targets)
+
+            ws_day = workbook.add_worksheet("日別")
+
+            # 書式
+            fmt_date_day = workbook.add_format({"num_format": "yyyy/m/d", "align": "center"})
+            fmt_num_int  = workbook.add_format({"num_format": "#,##0", "align": "right"})
+            fmt_num_f2   = workbook.add_format({"num_format": "#,##0.00", "align": "right"})
+
+            # 列幅（D/E は列書式で数値書式を当てる）
+            ws_day.set_column(0, 0, 12)              # A:日付
+            ws_day.set_column(1, 1, 24)              # B:割り振り
+            ws_day.set_column(2, 2, 16)              # C:領域
+            ws_day.set_column(3, 3, 12, fmt_num_int) # D:合計値
+            ws_day.set_column(4, 4, 14, fmt_num_f2)  # E:目標
+
+            ws_day.write_row(0, 0, list(df_day.columns), fmt_header)
+            # ★A列は datetime 書式（yyyy/m/d）、B列以降は書式なし＝列書式
+            _write_blocks(ws_day, 1, [
+                (0, [_excel_dates(df_day["日付"])], fmt_date_day),
+                (1, [_excel_values(df_day[c]) for c in df_day.columns[1:]], None),
+            ])
+
+        # 3) コストレポート日別（全期間）※日付も yyyy/m/d に統一
+        if daily_cost_df is not None and not daily_cost_df.empty:
+            ws2 = workbook.add_worksheet("コストレポート日別")
+            fmt_center = workbook.add_format({"align": "center", "valign": "vcenter", "border": 1})
+            fmt_date = workbook.add_format({"num_format": "yyyy/m/d", "border": 1, "align": "center"})
+            fmt_num = workbook.add_format({"num_format": "#,##0.00", "border": 1})
+
+            ws2.set_column(0, 0, 12)   # 日付
+            ws2.set_column(1, 12, 14)  # 値
+
+            # 見出しも行順に書く（constant_memory では戻って書いたセルは捨てられる）。
+            # A1:A3 の縦結合は後の行へ空白を書くため、constant_memory のときは結合せず罫線付きの空白で代える
+            if constant_memory:
+                ws2.write(0, 0, "日付", fmt_center)
+            else:
+                ws2.merge_range(0, 0, 2, 0, "日付", fmt_center)
+            ws2.merge_range(0, 1, 0, 6, "Forecast", fmt_center)
+            ws2.merge_range(0, 7, 0, 12, "実績", fmt_center)
+            ws2.write(0, 14, "備考")
+            ws2.write(0, 15, "全期間集計（読み込み可能な最小～最大日付）")
+            if constant_memory: ws2.write_blank(1, 0, None, fmt_center)
+            ws2.merge_range(1, 1, 1, 3, "AFCV", fmt_center)
+            ws2.merge_range(1, 4, 1, 6, "配信費", fmt_center)
+            ws2.merge_range(1, 7, 1, 9, "AFCV", fmt_center)
+            ws2.merge_range(1, 10, 1, 12, "配信費", fmt_center)
+            if constant_memory: ws2.write_blank(2, 0, None, fmt_center)
+            ws2.write_row(2, 1, ["Listing", "Display", "Affiliate"] * 4, fmt_center)
+
+            order_cols = DAILY_COST_REPORT_COLUMNS
+            dfw = daily_cost_df.reindex(columns=["日付"] + order_cols, fill_value=0.0)
+            values = dfw[order_cols].to_numpy(dtype="float64")
+            _write_blocks(ws2, 3, [
+                (0, [_excel_dates(dfw["日付"])], fmt_date),
+                (1, [col.tolist() for col in values.T], fmt_num),
+            ])
+
+# =====================
+# 機械向け出力（Excel と同じ3表を書式なしで。Parquet / gzip CSV を1表1ファイルで zip にまとめる）
+# =====================
+def export_tables(final_df, daily_allocation_df, daily_targets, daily_cost_df) -> dict:
+    """Excel の3シートと同じ表を {シート名: DataFrame} で返す（行のない表は含めない）。
+    日付は datetime64、分類・媒体・割り振り・領域は category、合計費用の空欄は NaN。"""
+    tables = {}
+    if final_df is not None and len(final_df) > 0:
+        df = final_df.copy()
+        df["合計費用"] = pd.to_numeric(df["合計費用"], errors="coerce")
+        tables["申込件数"] = df.astype({"分類": "category", "媒体": "category", "CV合計": float, "CV日割り": float})
+    if daily_allocation_df is not None and len(daily_allocation_df) > 0:
+        tables["日別"] = daily_allocation_with_targets(daily_allocation_df, daily_targets).astype(
+            {"割り振り": "category", "領域": "category"})
+    if daily_cost_df is not None and not daily_cost_df.empty:
+        df = daily_cost_df.reindex(columns=["日付"] + DAILY_COST_REPORT_COLUMNS, fill_value=0.0)
+        df["日付"] = pd.to_datetime(df["日付"])
+        tables["コストレポート日別"] = df.astype({c: float for c in DAILY_COST_REPORT_COLUMNS})
+    return tables
+
+def _write_table_zip(path: str, tables: dict, ext: str, write):
+    # 中身が圧縮済み（Parquet / gzip）なので zip 自体は無圧縮でまとめる
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        for name, df in tables.items():
+            buf = BytesIO()
+            write(df, buf)
+            zf.writestr(f"{name}{ext}", buf.getvalue())
+
+def write_export_parquet(path: str, final_df, daily_allocation_df, daily_targets, daily_cost_df,
+                         start_date=None, end_date=None, days: int = None):
+    """3表を Parquet（pyarrow。日付は timestamp、category は dictionary 型）で書き、zip にまとめる。"""
+    _write_table_zip(path, export_tables(final_df, daily_allocation_df, daily_targets, daily_cost_df), ".parquet",
+                     lambda df, buf: df.to_parquet(buf, index=False))
+
+def write_export_csv_gz(path: str, final_df, daily_allocation_df, daily_targets, daily_cost_df,
+                        start_date=None, end_date=None, days: int = None):
+    """3表を UTF-8 の gzip CSV（日付は YYYY-MM-DD）で書き、zip にまとめる。"""
+    _write_table_zip(path, export_tables(final_df, daily_allocation_df, daily_targets, daily_cost_df), ".csv.gz",
+                     lambda df, buf: df.to_csv(buf, index=False, date_format="%Y-%m-%d",
+                                               compression={"method": "gzip", "mtime": 0}))
+
+# 出力形式 → (書き出し関数, 拡張子)。どの関数も write_export_workbook と同じ引数を取る
+EXPORT_FORMATS = {
+    "xlsx": (write_export_workbook, ".xlsx"),
+    "parquet": (write_export_parquet, ".parquet.zip"),
+    "csv": (write_export_csv_gz, ".csv.zip"),
+}
+
+# =====================
+# 一括集計（画面を使わない実行。batch_summary.py から使う）
+# =====================
+def prepare_inputs(cv_file=None, cost_file=None, af_master: pd.DataFrame = None, executor: Executor = None) -> dict:
+    """ブック単位の解析・事前集計（画面のバックグラウンドパイプラインと同じ段）。期間には依存しない。"""
+    r = {}
+    if cv_file is not None:
+        r["cv"] = parse_cv(cv_file, af_master)
+        r["cv_codes"] = classify_codes(r["cv"].columns[1:], af_master)
+        r["cv_cube"] = build_cv_cube(r["cv"], r["cv_codes"])
+    if cost_file is not None:
+        r["cost_sheets"] = load_cost_sheets(cost_file, executor=executor)
+        r["cost_cube"] = build_cost_cube(r["cost_sheets"])
+        r["daily_cost"] = build_daily_cost_report_all_range(r["cost_sheets"])
+        r["daily_targets"] = build_daily_targets_from_cost(r["cost_sheets"])
+    return r
+
+def summarize_period(inputs: dict, start_date, end_date) -> dict:
+    """期間を適用した出力テーブル一式を返す（キーは write_export_workbook の引数名）。"""
+    days = period_days(start_date, end_date)
+    cv_result_base = None
+    daily_allocation_df = None
+    if "cv_cube" in inputs:
+        cv_result_base = cv_totals_for_period(inputs["cv_cube"], start_date, end_date)
+        daily_allocation_df = daily_cv_by_media(filter_period(inputs["cv"], start_date, end_date), inputs["cv_codes"])
+    cost_summary = cost_summary_for_period(inputs.get("cost_cube"), start_date, end_date)
+    has_daily = daily_allocation_df is not None and len(daily_allocation_df) > 0
+    return {
+        "final_df": build_condition_table(cv_result_base, cost_summary, days, with_cost="cost_cube" in inputs),
+        "daily_allocation_df": daily_allocation_df,
+        "daily_targets": inputs.get("daily_targets") if has_daily else None,
+        "daily_cost_df": inputs.get("daily_cost"),
+        "start_date": start_date, "end_date": end_date, "days": days,
+    }
+
+def has_export_rows(summary: dict) -> bool:
+    """Excel に書き出す行が1つでもあるか（画面のダウンロードボタン表示条件と同じ）。"""
+    return any(
+        summary[k] is not None and len(summary[k]) > 0
+        for k in ("final_df", "daily_allocation_df", "daily_cost_df")
+    )